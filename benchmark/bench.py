@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------
+# Measures screengraph's per-event overhead with a stand-in lldb module
+# (benchmark/stubs/lldb.py): drives BreakpointTracer.on_breakpoint_hit
+# and TouchTracer.on_touch through the outputs, for session sizes from
+# 100 to 1M events, and reports per-event (stop) latency percentiles,
+# total time including draining the writer thread, peak memory and
+# bytes written. Each run happens in its own process so peak memory is
+# per run. With --non-stop, touches are appended to the recorder's ring
+# buffer by a stand-in writer (benchmark/stubs/recorder.py) instead.
+#
+#   python benchmark/bench.py [--outputs graphviz,all] [--max 1000000] [--latency 0.5] [--non-stop] [--json]
+# ---------------------------------------------------------------------
+
+from __future__ import print_function
+
+import array
+import json
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, 'stubs'))
+sys.path.insert(0, os.path.join(here, '..'))
+
+configurations = {
+    'text': {'text': True, 'screenshot': False, 'graphviz': False},
+    'screenshot': {'text': False, 'screenshot': True, 'graphviz': False},
+    'graphviz': {'text': False, 'screenshot': False, 'graphviz': True},
+    'spill': {'text': False, 'screenshot': False, 'graphviz': True, 'max_nodes': 10000},
+    'linear': {'text': False, 'screenshot': False, 'graphviz': True, 'reentry': False},
+    'record': {'screenshot': True, 'record': True},
+    'sqlite': {'text': False, 'screenshot': False, 'graphviz': False, 'sqlite': True},
+    'all': {'text': True, 'screenshot': True, 'graphviz': True},
+}
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def bytes_written(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def run(configuration, events, latency, touches, non_stop=False):
+    import lldb
+    import recorder
+    import screengraph
+    
+    lldb.expression_latency = latency
+    debugger = lldb.debugger
+    target = debugger.GetSelectedTarget()
+    process = target.GetProcess()
+    thread = process.GetSelectedThread()
+    for _ in range(4):
+        target.add_breakpoint()
+    
+    directory = tempfile.mkdtemp()
+    try:
+        runtime = screengraph.Runtime(debugger)
+        runtime.install()
+        runtime.install_visible_key_tracking()
+        command = screengraph.ScreenGraphCommand(debugger, None)
+        outputs = command.make_outputs(runtime, directory, **configurations[configuration])
+        dispatcher = screengraph.Dispatcher(outputs)
+        breakpoints = list(target.breakpoint_iter()) # not the touch tracer's
+        tracers = command.make_tracers(debugger, dispatcher, runtime, recorder=({'directory': directory} if non_stop else None))
+        [tracer.start() for tracer in tracers]
+        breakpoint_tracer, touch_tracer = tracers
+        if non_stop:
+            writer = recorder.Writer(touch_tracer.filename)
+            screenshot = os.path.join(directory, 'screenshot_r%i.png') if touch_tracer.screenshots else None
+        
+        latencies = array.array('d')
+        timer = timeit.default_timer
+        start = timer()
+        for i in xrange(events):
+            process.screen = (i // 10) % lldb.screens
+            if i % touches == 0 and non_stop:
+                t = timer()
+                writer.touch(float(i % 320), float(i % 480), 'Screen%i' % process.screen, screenshot)
+            elif i % touches == 0:
+                process.touch = (float(i % 320), float(i % 480))
+                frame = lldb.SBFrame(thread, lldb.TOUCH_HOOK_ADDRESS)
+                location = lldb.SBBreakpointLocation(touch_tracer.hitTest)
+                t = timer()
+                touch_tracer.on_touch(frame, location, {})
+            else:
+                breakpoint = breakpoints[i % len(breakpoints)]
+                frame = lldb.SBFrame(thread, 0x100000000 + breakpoint.id * 0x10, 'function%i(_:)' % breakpoint.id)
+                location = lldb.SBBreakpointLocation(breakpoint)
+                t = timer()
+                breakpoint_tracer.on_breakpoint_hit(frame, location, {})
+            latencies.append(timer() - t)
+        [tracer.stop() for tracer in tracers]
+        if non_stop:
+            writer.close()
+        dispatcher.close()
+        total = timer() - start
+        
+        latencies = sorted(latencies)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            'outputs': configuration,
+            'events': events,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1],
+            'total': total,
+            'continues': process.continues,
+            'peak_memory': maxrss * (1 if sys.platform == 'darwin' else 1024),
+            'bytes_written': bytes_written(directory),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--outputs', default=','.join(sorted(configurations)),
+                      help='Comma-separated output configurations: %s (default=all of them)' % ', '.join(sorted(configurations)))
+    parser.add_option('--min', type='int', default=100, help='Smallest number of events (default=100)')
+    parser.add_option('--max', type='int', default=1000000, help='Largest number of events (default=1000000)')
+    parser.add_option('--latency', type='float', default=0, help='Simulated expression latency, in ms (default=0)')
+    parser.add_option('--touches', type='int', default=3, help='One event in so many is a touch (default=3)')
+    parser.add_option('--non-stop', action='store_true', default=False, help='Record touches to the ring buffer instead of stopping')
+    parser.add_option('--json', action='store_true', default=False, help='Print one JSON result per line')
+    parser.add_option('--run', nargs=2, metavar='OUTPUTS EVENTS', help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    
+    if options.run:
+        print(json.dumps(run(options.run[0], int(options.run[1]), options.latency / 1000.0, options.touches, options.non_stop)))
+        return
+    
+    if not options.json:
+        print('%-10s %8s %10s %10s %10s %10s %10s %10s %12s' % (
+            'outputs', 'events', 'p50 (us)', 'p95 (us)', 'p99 (us)', 'max (us)', 'total (s)', 'peak (MB)', 'written (KB)'))
+    for configuration in options.outputs.split(','):
+        events = options.min
+        while events <= options.max:
+            result = json.loads(subprocess.check_output([
+                sys.executable, os.path.abspath(__file__),
+                '--run', configuration, str(events),
+                '--latency', str(options.latency),
+                '--touches', str(options.touches),
+            ] + (['--non-stop'] if options.non_stop else [])).splitlines()[-1])
+            if options.json:
+                print(json.dumps(result))
+            else:
+                print('%-10s %8i %10.1f %10.1f %10.1f %10.1f %10.2f %10.1f %12i' % (
+                    configuration,
+                    events,
+                    result['p50'] * 1e6,
+                    result['p95'] * 1e6,
+                    result['p99'] * 1e6,
+                    result['max'] * 1e6,
+                    result['total'],
+                    result['peak_memory'] / 1048576.0,
+                    result['bytes_written'] // 1024,
+                ))
+            sys.stdout.flush()
+            events *= 10
+
+
+if __name__ == '__main__':
+    main()
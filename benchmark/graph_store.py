@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+# ---------------------------------------------------------------------
+# Micro-benchmark for GraphvizOutput's graph store: inserts N events
+# (one node and one edge each) and serializes the graph, for N up to 1M.
+# Per-event times should stay flat as N grows.
+#
+#   python benchmark/graph_store.py [--max 1000000] [--screens 50]
+# ---------------------------------------------------------------------
+
+from __future__ import print_function
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import screengraph
+
+
+def run(events, screens, reentry):
+    directory = tempfile.mkdtemp()
+    try:
+        output = screengraph.GraphvizOutput(directory, reentry=reentry)
+        graph = output.graph
+        
+        start = time.time()
+        last = None
+        for i in xrange(events):
+            cluster = graph.cluster('Screen%i' % (i % screens)) if reentry else -1
+            node = graph.add_node('t%i' % i, cluster, 'screenshot_t%i.png' % i, 'Touch (%i, %i)' % (i % 320, i % 480))
+            if last is not None:
+                graph.add_edge(last, node)
+            last = node
+        insert = time.time() - start
+        
+        start = time.time()
+        with open(os.devnull, 'w') as f:
+            output.serialize(f)
+        serialize = time.time() - start
+        
+        output.close()
+        return insert, serialize
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--max', type='int', default=1000000, help='Largest number of events (default=1000000)')
+    parser.add_option('--screens', type='int', default=50, help='Number of distinct screen keys (default=50)')
+    (options, args) = parser.parse_args()
+    
+    print('%-8s %10s %12s %12s %14s %14s' % ('type', 'events', 'insert (s)', 'us/event', 'serialize (s)', 'us/event'))
+    for reentry in (False, True):
+        events = 100
+        while events <= options.max:
+            insert, serialize = run(events, options.screens, reentry)
+            print('%-8s %10i %12.3f %12.2f %14.3f %14.2f' % (
+                'graph' if reentry else 'linear',
+                events,
+                insert,
+                insert / events * 1e6,
+                serialize,
+                serialize / events * 1e6,
+            ))
+            events *= 10
+
+
+if __name__ == '__main__':
+    main()
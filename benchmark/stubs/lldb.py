@@ -0,0 +1,364 @@
+# ---------------------------------------------------------------------
+# Stand-in for LLDB's python module, for benchmarking screengraph
+# without a debugger or an app. Only what screengraph uses is
+# implemented. Expressions answer like ScreenGraphRuntime would, after
+# sleeping for expression_latency seconds.
+# ---------------------------------------------------------------------
+
+import re
+import struct
+import time
+
+eLanguageTypeSwift = 30
+eLanguageTypeObjC = 16
+eStopReasonNone = 1
+eStopReasonBreakpoint = 3
+
+expression_latency = 0.0 # seconds, per EvaluateExpression call
+screen_size = (64, 96) # pixels of the fake key window
+screens = 20 # distinct view controllers / screen contents
+
+TOUCH_LOCATION_ADDRESS = 0x1000
+TOUCH_HOOK_ADDRESS = 0x2000
+VISIBLE_KEY_ADDRESS = 0x3000
+PIXELS_ADDRESS = 0x100000
+
+
+class SBError(object):
+    
+    def __init__(self, message=None):
+        self.message = message
+    
+    def Fail(self):
+        return self.message is not None
+    
+    def Success(self):
+        return self.message is None
+    
+    def __str__(self):
+        return self.message or 'success'
+
+
+class SBExpressionOptions(object):
+    
+    def __init__(self):
+        self.settings = {}
+    
+    def __getattr__(self, name):
+        if name.startswith('Set'):
+            return lambda value: self.settings.__setitem__(name[3:], value)
+        raise AttributeError(name)
+
+
+class SBValue(object):
+    
+    def __init__(self, value=None, description=None, children=None, error=None):
+        self.value = value
+        self.description = description
+        self.children = children or {}
+        self.error = SBError(error)
+    
+    def GetError(self):
+        return self.error
+    
+    def GetValue(self):
+        return None if self.value is None else str(self.value)
+    
+    def GetValueAsUnsigned(self):
+        return int(self.value or 0)
+    
+    def GetObjectDescription(self):
+        return self.description
+    
+    def GetSummary(self):
+        return None if self.description is None else '@"%s"' % self.description
+    
+    def GetChildMemberWithName(self, name):
+        return SBValue(self.children.get(name))
+
+
+class SBBreakpoint(object):
+    
+    def __init__(self, target, identifier):
+        self.target = target
+        self.id = identifier
+        self.callback = None
+        self.condition = None
+        self.enabled = True
+    
+    def GetID(self):
+        return self.id
+    
+    def IsValid(self):
+        return self.id in self.target.breakpoints
+    
+    def IsEnabled(self):
+        return self.enabled
+    
+    def SetEnabled(self, enabled):
+        self.enabled = enabled
+    
+    def SetCondition(self, condition):
+        self.condition = condition
+    
+    def SetScriptCallbackFunction(self, function):
+        self.callback = function
+    
+    def FindLocationByID(self, identifier):
+        return SBBreakpointLocation(self, identifier)
+    
+    def __str__(self):
+        return 'SBBreakpoint: id = %i' % self.id
+
+
+class SBBreakpointLocation(object):
+    
+    def __init__(self, breakpoint, identifier=1):
+        self.breakpoint = breakpoint
+        self.id = identifier
+    
+    def GetBreakpoint(self):
+        return self.breakpoint
+    
+    def GetID(self):
+        return self.id
+
+
+class SBProcess(object):
+    
+    processes = 0
+    
+    def __init__(self, target):
+        SBProcess.processes += 1
+        self.id = SBProcess.processes
+        self.target = target
+        self.continues = 0
+        self.stops = 0
+        self.resumed = False # the next frame is from a new stop
+        self.touch = (0.0, 0.0)
+        self.screen = 0
+        self.thread = SBThread(self, 1)
+        self.threads = [self.thread]
+    
+    def Continue(self):
+        self.continues += 1
+        self.resumed = True
+        for thread in self.threads:
+            thread.stop = None
+        return SBError()
+    
+    def GetStopID(self):
+        return self.stops
+    
+    def GetTarget(self):
+        return self.target
+    
+    def GetNumThreads(self):
+        return len(self.threads)
+    
+    def GetThreadAtIndex(self, index):
+        return self.threads[index]
+    
+    def add_thread(self):
+        self.threads.append(SBThread(self, len(self.threads) + 1))
+        return self.threads[-1]
+    
+    def IsValid(self):
+        return True
+    
+    def GetUniqueID(self):
+        return self.id
+    
+    def GetProcessID(self):
+        return 1000 + self.id
+    
+    def GetSelectedThread(self):
+        return self.thread
+    
+    def ReadMemory(self, address, size, error):
+        if address == TOUCH_LOCATION_ADDRESS:
+            return struct.pack('=dd', *self.touch)[:size]
+        if address == PIXELS_ADDRESS:
+            return (chr(self.screen % 256) * 4) * (size // 4)
+        error.message = 'memory read failed for 0x%x' % address
+        return None
+    
+    def ReadCStringFromMemory(self, address, size, error):
+        return 'Screen%i' % self.screen
+
+
+class SBThread(object):
+    
+    def __init__(self, process, identifier):
+        self.process = process
+        self.id = identifier
+        self.stop = None # (frame, breakpoint id, location id) when stopped at a breakpoint
+    
+    def GetProcess(self):
+        return self.process
+    
+    def GetThreadID(self):
+        return self.id
+    
+    def GetIndexID(self):
+        return self.id
+    
+    def GetStopReason(self):
+        return eStopReasonBreakpoint if self.stop else eStopReasonNone
+    
+    def GetStopReasonDataCount(self):
+        return 2 if self.stop else 0
+    
+    def GetStopReasonDataAtIndex(self, index):
+        return self.stop[1 + index]
+    
+    def GetFrameAtIndex(self, index):
+        return self.stop[0] if self.stop else self.GetSelectedFrame()
+    
+    def GetSelectedFrame(self):
+        return SBFrame(self, 0x100000000)
+
+
+class SBFrame(object):
+    
+    def __init__(self, thread, pc, function='ViewController.buttonTapped(_:)'):
+        self.thread = thread
+        self.pc = pc
+        self.name = function
+        thread.process.target.symbols[pc] = function
+        if thread.process.resumed:
+            thread.process.stops += 1
+            thread.process.resumed = False
+    
+    def IsValid(self):
+        return True
+    
+    def GetThread(self):
+        return self.thread
+    
+    def GetPC(self):
+        return self.pc
+    
+    def __str__(self):
+        return 'frame #0: 0x%016x App`%s(sender=0x0000600000c10000) at ViewController.swift:%i' % (
+            self.pc,
+            self.name,
+            self.pc % 100,
+        )
+    
+    def EvaluateExpression(self, expression, options=None):
+        if expression_latency:
+            time.sleep(expression_latency)
+        process = self.thread.process
+        key = 'Screen%i' % process.screen
+        if 'captureRaw' in expression:
+            width, height = screen_size
+            return SBValue(description='%s\traw %i %i %i %i' % (key, PIXELS_ADDRESS, width, height, width * 4))
+        match = re.search(r'capture:@"([^"]*)"', expression)
+        if match:
+            with open(match.group(1), 'wb') as f:
+                f.write(key)
+            return SBValue(description='%s\tsaved' % key)
+        if 'capture:nil' in expression:
+            return SBValue(description='%s\tskipped' % key)
+        if 'touchLocationAddress' in expression:
+            return SBValue(TOUCH_LOCATION_ADDRESS)
+        if 'installTouchHook' in expression:
+            return SBValue(TOUCH_HOOK_ADDRESS)
+        if 'startRecorder' in expression:
+            return SBValue(1)
+        if 'installVisibleKeyTracking' in expression:
+            return SBValue(VISIBLE_KEY_ADDRESS)
+        if 'CGPoint point' in expression:
+            return SBValue(children={'x': process.touch[0], 'y': process.touch[1]})
+        return SBValue(0)
+
+
+class SBAddress(object):
+    
+    def __init__(self, target, load_address):
+        self.target = target
+        self.load_address = load_address
+    
+    def __str__(self):
+        return 'App`%s + 0 at ViewController.swift:%i' % (
+            self.target.symbols.get(self.load_address, '0x%x' % self.load_address),
+            self.load_address % 100,
+        )
+
+
+class SBFileSpec(object):
+    
+    def __init__(self, filename):
+        self.filename = filename
+    
+    def GetFilename(self):
+        return self.filename
+
+
+class SBTarget(object):
+    
+    def __init__(self):
+        self.breakpoints = {}
+        self.symbols = {} # load address -> function name, registered by frames
+        self.process = SBProcess(self)
+    
+    def IsValid(self):
+        return True
+    
+    def GetProcess(self):
+        return self.process
+    
+    def GetExecutable(self):
+        return SBFileSpec('App')
+    
+    def GetTriple(self):
+        return 'x86_64-apple-ios'
+    
+    def ResolveLoadAddress(self, load_address):
+        return SBAddress(self, load_address)
+    
+    def FindBreakpointByID(self, identifier):
+        return self.breakpoints[identifier]
+    
+    def breakpoint_iter(self):
+        return iter(self.breakpoints.values())
+    
+    def add_breakpoint(self):
+        breakpoint = SBBreakpoint(self, len(self.breakpoints) + 1)
+        self.breakpoints[breakpoint.id] = breakpoint
+        return breakpoint
+    
+    def BreakpointCreateByName(self, name):
+        return self.add_breakpoint()
+    
+    def BreakpointCreateByAddress(self, address):
+        return self.add_breakpoint()
+    
+    def BreakpointDelete(self, identifier):
+        return self.breakpoints.pop(identifier, None) is not None
+
+
+class SBDebugger(object):
+    
+    def __init__(self):
+        self.targets = [SBTarget()]
+    
+    def GetSelectedTarget(self):
+        return self.targets[0]
+    
+    def GetNumTargets(self):
+        return len(self.targets)
+    
+    def GetTargetAtIndex(self, index):
+        return self.targets[index]
+    
+    def add_target(self):
+        self.targets.append(SBTarget())
+        return self.targets[-1]
+    
+    def HandleCommand(self, command):
+        pass
+
+
+debugger = SBDebugger()
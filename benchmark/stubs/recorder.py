@@ -0,0 +1,60 @@
+# ---------------------------------------------------------------------
+# Stand-in for the recorder screengraph injects into the app for
+# --non-stop (ScreenGraphRuntime.record): appends records to a ring
+# buffer file created by screengraph.Recorder, in the same format, so
+# the host side can be exercised without a simulator.
+# ---------------------------------------------------------------------
+
+import mmap
+import struct
+import time
+
+HEADER = struct.Struct('<4sIII') # magic, version, capacity, reserved
+POSITION = struct.Struct('<Q') # bytes written, at HEADER.size
+RECORD = struct.Struct('<HBBIdffHH') # size, kind, flags, sequence, time, x, y, key length, text length
+OFFSET = 64
+KEY_SIZE = 256
+
+TOUCH = 1
+MARK = 2
+SAVED = 1
+
+
+class Writer(object):
+    
+    def __init__(self, filename):
+        self.file = open(filename, 'r+b')
+        magic, version, self.capacity, _ = HEADER.unpack(self.file.read(HEADER.size))
+        assert magic == 'SGRB' and version == 1, 'not a recorder ring buffer'
+        self.map = mmap.mmap(self.file.fileno(), OFFSET + self.capacity)
+        self.sequence = 0
+    
+    def append(self, kind, x=0.0, y=0.0, key='', text='', flags=0):
+        key = key[:KEY_SIZE]
+        text = text[:KEY_SIZE]
+        record = RECORD.pack(RECORD.size + len(key) + len(text), kind, flags, self.sequence, time.time(), x, y, len(key), len(text)) + key + text
+        self.sequence += 1
+        position, = POSITION.unpack_from(self.map, HEADER.size)
+        start = position % self.capacity
+        head = record[:self.capacity - start]
+        self.map[OFFSET + start:OFFSET + start + len(head)] = head
+        if len(head) < len(record):
+            self.map[OFFSET:OFFSET + len(record) - len(head)] = record[len(head):]
+        POSITION.pack_into(self.map, HEADER.size, position + len(record)) # publishes the record
+        return self.sequence - 1
+    
+    def touch(self, x, y, key, screenshot=None):
+        """With screenshot, a file name, writes a placeholder screenshot there, as the app would."""
+        flags = 0
+        if screenshot:
+            with open(screenshot % self.sequence, 'wb') as f:
+                f.write(key)
+            flags |= SAVED
+        return self.append(TOUCH, x, y, key, flags=flags)
+    
+    def mark(self, tag, key):
+        return self.append(MARK, key=key, text=tag)
+    
+    def close(self):
+        self.map.close()
+        self.file.close()
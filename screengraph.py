@@ -11,15 +11,43 @@
 
 from __future__ import print_function
 
+import array
+import atexit
 import collections
+import contextlib
+import hashlib
+import heapq
 import inspect
-import lldb
+import itertools
+import json
+import multiprocessing.pool
+try:
+    import lldb
+except ImportError: # outside of the debugger, e.g. offline tools and benchmarks
+    lldb = None
+import math
+import mmap
 import optparse
+try:
+    from PIL import Image
+except ImportError: # only needed to encode JPEG screenshots on the host
+    Image = None
 import os
-import sets
+import re
+import Queue
 import shlex
+import shutil
+import sqlite3
+import struct
+import subprocess
+import StringIO
 import sys
 import textwrap
+import threading
+import time
+from timeit import default_timer as timer
+import traceback
+import zlib
 
 
 def debug():
@@ -36,8 +64,86 @@ def make_directory_if_not_exist(directory):
         if e.errno != os.errno.EEXIST:
             raise
 
-def first_argument():
-    arch = lldb.debugger.GetSelectedTarget().GetTriple().split('-')[0]
+def write_png(filename, width, height, stride, data):
+    """Encodes 32-bit BGRA pixels (as rendered in the app) to a PNG file."""
+    rows = []
+    for y in xrange(height):
+        bgra = data[y * stride:y * stride + width * 4]
+        rgba = bytearray(bgra)
+        rgba[0::4] = bgra[2::4]
+        rgba[2::4] = bgra[0::4]
+        rows.append('\0')
+        rows.append(str(rgba))
+    
+    def chunk(kind, payload):
+        return struct.pack('>I', len(payload)) + kind + payload + struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff)
+    
+    with open(filename, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(''.join(rows), 6)))
+        f.write(chunk('IEND', ''))
+
+def write_image(filename, width, height, stride, data, format='png', quality=0.8):
+    """Encodes 32-bit BGRA pixels to PNG, or JPEG when PIL is available."""
+    if format == 'png':
+        write_png(filename, width, height, stride, data)
+    else:
+        image = Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', stride, 1)
+        image.convert('RGB').save(filename, 'JPEG', quality=int(quality * 100))
+
+def downsample(width, height, stride, data, size):
+    """Nearest-neighbour downsampling of BGRA pixels by an integer factor, to at most size pixels per side."""
+    factor = int(math.ceil(max(width, height) / float(size)))
+    if factor <= 1:
+        return width, height, stride, data
+    w = (width + factor - 1) // factor
+    h = (height + factor - 1) // factor
+    pixels = bytearray(w * h * 4)
+    for y in xrange(h):
+        row = data[y * factor * stride:y * factor * stride + width * 4]
+        for channel in xrange(4):
+            pixels[y * w * 4 + channel:(y + 1) * w * 4:4] = row[channel::4 * factor]
+    return w, h, w * 4, str(pixels)
+
+def dhash(width, height, stride, data, size=8, samples=4):
+    """
+    Difference hash of BGRA pixels: the luminance of a (size+1) x size grid
+    of cells, each averaged over samples x samples pixels, one bit per pair
+    of horizontally adjacent cells.
+    """
+    columns = size + 1
+    grid = []
+    for row in xrange(size):
+        for column in xrange(columns):
+            total = 0
+            for j in xrange(samples):
+                y = ((row * samples + j) * 2 + 1) * height // (2 * size * samples)
+                for i in xrange(samples):
+                    offset = y * stride + (((column * samples + i) * 2 + 1) * width // (2 * columns * samples)) * 4
+                    total += 114 * ord(data[offset]) + 587 * ord(data[offset + 1]) + 299 * ord(data[offset + 2])
+            grid.append(total)
+    hash = 0
+    for row in xrange(size):
+        for column in xrange(size):
+            hash = (hash << 1) | (grid[row * columns + column] > grid[row * columns + column + 1])
+    return hash
+
+def dhash_file(filename, size=8):
+    """Difference hash of an image file, see dhash; needs PIL."""
+    image = Image.open(filename).convert('L').resize((size + 1, size), Image.ANTIALIAS)
+    pixels = list(image.getdata())
+    hash = 0
+    for row in xrange(size):
+        for column in xrange(size):
+            hash = (hash << 1) | (pixels[row * (size + 1) + column] > pixels[row * (size + 1) + column + 1])
+    return hash
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def first_argument(target):
+    arch = target.GetTriple().split('-')[0]
     if 'x86' in arch:
         first_arg = '(id)$rdx'
     elif 'arm' in arch:
@@ -46,333 +152,1915 @@ def first_argument():
     return first_arg
 
 
-class singleton:
+class Histogram(object):
+    """Fixed-size histogram of durations, in logarithmic buckets of about 9% from 1us."""
+    
+    base = 1e-6
+    ratio = 2 ** (1 / 8.0)
+    size = 256
+    
+    def __init__(self):
+        self.counts = array.array('l', [0] * Histogram.size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, seconds):
+        index = int(math.log(seconds / Histogram.base, Histogram.ratio)) if seconds > Histogram.base else 0
+        self.counts[min(index, Histogram.size - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    def percentile(self, p):
+        rank = self.count * p / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.max, Histogram.base * Histogram.ratio ** (index + 0.5))
+        return self.max
+
+
+class Stats:
+    """
+    Per-phase timings of the tracers and outputs, see 'screengraph stats'.
+    Recorded from the LLDB callbacks and from the writer, encoder, renderer
+    and recorder threads, under a lock.
+    """
+    
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.timings = None
+        self.lock = threading.Lock()
+    
+    def reset(self, timings=None):
+        """Clears all timings; with a file name, also writes each raw timing to it."""
+        self.close()
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.timings = open(timings, 'w') if timings else None
+    
+    def record(self, phase, seconds):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.add(seconds)
+            if self.timings:
+                self.timings.write('%s\t%.9f\n' % (phase, seconds))
+    
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+    
+    @contextlib.contextmanager
+    def timed(self, phase):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.record(phase, timer() - start)
+    
+    def report(self):
+        with self.lock:
+            return self.report_locked()
+    
+    def report_locked(self):
+        lines = ['%-28s %10s %10s %10s %10s %10s %10s' % ('phase', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)', 'total (s)')]
+        for phase, histogram in self.histograms.items():
+            lines.append('%-28s %10i %10.2f %10.2f %10.2f %10.2f %10.2f' % (
+                phase,
+                histogram.count,
+                histogram.percentile(50) * 1000,
+                histogram.percentile(95) * 1000,
+                histogram.percentile(99) * 1000,
+                histogram.max * 1000,
+                histogram.total,
+            ))
+        for counter, n in self.counters.items():
+            lines.append('%-28s %10i' % (counter, n))
+        return '\n'.join(lines)
+    
+    def close(self):
+        if self.timings:
+            self.timings.close()
+            self.timings = None
+
+stats = Stats()
+
+
+#-- Runtime
+
+class Runtime:
+    """
+    Screengraph code installed into the app once at start (a single Swift
+    compile), then called through a short Objective-C message send.
+    """
     
-    def __init__(self, klass):
-        self.klass = klass
-        self.instance = None
+    key_size = 256 # bytes, for the visible view controller key tracked by the app
+    
+    source = """
+        import UIKit
+        @objc(ScreenGraphRuntime) public class ScreenGraphRuntime: NSObject {
+        
+            static func visibleViewController(_ rootViewController: UIViewController?) -> UIViewController? {
+                let viewController = rootViewController ?? UIApplication.shared.keyWindow?.rootViewController
+                if let presented = viewController?.presentedViewController {
+                    return visibleViewController(presented)
+                }
+                if let navigationController = viewController as? UINavigationController {
+                    return visibleViewController(navigationController.viewControllers.last!)
+                }
+                if let tabBarController = viewController as? UITabBarController {
+                    return visibleViewController(tabBarController.selectedViewController!)
+                }
+                return viewController
+            }
+            
+            static func visibleViewControllerKey() -> String {
+                let viewController = visibleViewController(nil)
+                return viewController?.title ?? (viewController != nil ? NSStringFromClass(type(of:viewController!)) : "unknown")
+            }
+            
+            static func highlight(_ window: UIWindow, _ point: CGPoint) {
+                let circleView = UIView(frame: CGRect(x: 0, y: 0, width: %(size)i, height: %(size)i))
+                circleView.center = point
+                circleView.alpha = 0.5
+                circleView.layer.cornerRadius = %(size)i/2
+                circleView.backgroundColor = UIColor.%(color)s
+                circleView.isUserInteractionEnabled = false
+                window.addSubview(circleView)
+                UIView.animate(withDuration: %(duration)f, delay: 0.0, options: [], animations: {
+                    circleView.alpha = 0.0
+                }, completion: { (finished: Bool) in
+                    circleView.removeFromSuperview()
+                })
+            }
+            
+            static var scale: CGFloat = 1
+            static var maxSize = 0
+            static var format = "png"
+            static var quality: CGFloat = 0.8
+            static var thumbnailSize = 0
+            static var keepOriginal = false
+            
+            @objc public static func configure(_ scale: Double, maxSize: Int, format: NSString, quality: Double, thumbnailSize: Int, keepOriginal: Bool) {
+                self.scale = CGFloat(scale)
+                self.maxSize = maxSize
+                self.format = format as String
+                self.quality = CGFloat(quality)
+                self.thumbnailSize = thumbnailSize
+                self.keepOriginal = keepOriginal
+            }
+            
+            static func renderScale(_ bounds: CGRect, _ size: Int) -> CGFloat {
+                return size > 0 ? min(scale, CGFloat(size) / max(bounds.width, bounds.height)) : scale
+            }
+            
+            static func encode(_ image: UIImage) -> Data? {
+                switch format {
+                case "jpeg":
+                    return image.jpegData(compressionQuality: quality)
+                case "heic":
+                    let data = NSMutableData()
+                    guard let cgImage = image.cgImage,
+                        let destination = CGImageDestinationCreateWithData(data, "public.heic" as CFString, 1, nil) else {
+                        return nil
+                    }
+                    CGImageDestinationAddImage(destination, cgImage, [kCGImageDestinationLossyCompressionQuality: quality] as CFDictionary)
+                    return CGImageDestinationFinalize(destination) ? data as Data : nil
+                default:
+                    return image.pngData()
+                }
+            }
+            
+            static func screenshot(_ window: UIWindow, _ path: String) -> String {
+                let view = window.screen.snapshotView(afterScreenUpdates: true)
+                let thumbnailPath = (path as NSString).deletingPathExtension + "_thumb." + (path as NSString).pathExtension
+                var files: [(String, Int)] = []
+                if thumbnailSize > 0 {
+                    files.append((thumbnailPath, thumbnailSize))
+                }
+                if thumbnailSize == 0 || keepOriginal {
+                    files.append((path, maxSize))
+                }
+                for (file, size) in files {
+                    UIGraphicsBeginImageContextWithOptions(view.bounds.size, true, renderScale(view.bounds, size))
+                    defer { UIGraphicsEndImageContext() }
+                    view.drawHierarchy(in: view.bounds, afterScreenUpdates: true)
+                    guard let image = UIGraphicsGetImageFromCurrentImageContext(), let data = encode(image) else {
+                        return "could not take a screenshot"
+                    }
+                    do {
+                        try data.write(to: URL(fileURLWithPath: file))
+                    } catch {
+                        return "error saving screenshot: \\(error)"
+                    }
+                }
+                return "saved"
+            }
+            
+            @objc public static func capture(_ path: NSString?, x: Double, y: Double, highlight: Bool) -> NSString {
+                let key = visibleViewControllerKey()
+                guard let window = UIApplication.shared.keyWindow else {
+                    return "\\(key)\\tno window" as NSString
+                }
+                if highlight {
+                    self.highlight(window, CGPoint(x: x, y: y))
+                }
+                let status = path != nil ? screenshot(window, path! as String) : "skipped"
+                return "\\(key)\\t\\(status)" as NSString
+            }
+            
+            static var pixels: UnsafeMutableRawPointer? = nil
+            static var pixelsCapacity = 0
+            
+            static func render(_ window: UIWindow) -> String {
+                let bounds = window.bounds
+                let scale = renderScale(bounds, maxSize)
+                let width = Int(bounds.width * scale), height = Int(bounds.height * scale), bytesPerRow = width * 4
+                if pixelsCapacity < bytesPerRow * height {
+                    pixels?.deallocate()
+                    pixels = UnsafeMutableRawPointer.allocate(byteCount: bytesPerRow * height, alignment: 16)
+                    pixelsCapacity = bytesPerRow * height
+                }
+                guard let context = CGContext(
+                    data: pixels, width: width, height: height, bitsPerComponent: 8, bytesPerRow: bytesPerRow,
+                    space: CGColorSpaceCreateDeviceRGB(),
+                    bitmapInfo: CGImageAlphaInfo.premultipliedFirst.rawValue | CGBitmapInfo.byteOrder32Little.rawValue
+                ) else {
+                    return "could not create a bitmap context"
+                }
+                context.translateBy(x: 0, y: CGFloat(height))
+                context.scaleBy(x: scale, y: -scale)
+                UIGraphicsPushContext(context)
+                defer { UIGraphicsPopContext() }
+                window.drawHierarchy(in: bounds, afterScreenUpdates: true)
+                return "raw \\(UInt(bitPattern: pixels)) \\(width) \\(height) \\(bytesPerRow)"
+            }
+            
+            @objc public static func captureRaw(_ x: Double, y: Double, highlight: Bool) -> NSString {
+                let key = visibleViewControllerKey()
+                guard let window = UIApplication.shared.keyWindow else {
+                    return "\\(key)\\tno window" as NSString
+                }
+                if highlight {
+                    self.highlight(window, CGPoint(x: x, y: y))
+                }
+                return "\\(key)\\t\\(render(window))" as NSString
+            }
+            
+            static let touchLocation = UnsafeMutablePointer<Double>.allocate(capacity: 2)
+            static var touchHookInstalled = false
+            
+            @objc public static func touchLocationAddress() -> UInt {
+                return UInt(bitPattern: touchLocation)
+            }
+            
+            @objc dynamic public static func touchBegan(_ x: Double, y: Double) {
+                // only called so the debugger can break here, see TouchTracer
+            }
+            
+            static func exchangeSendEvent() {
+                let original = class_getInstanceMethod(UIApplication.self, #selector(UIApplication.sendEvent(_:)))!
+                let hook = class_getInstanceMethod(UIApplication.self, #selector(UIApplication.screengraph_sendEvent(_:)))!
+                method_exchangeImplementations(original, hook)
+            }
+            
+            @objc public static func installTouchHook() -> UInt {
+                if !touchHookInstalled {
+                    exchangeSendEvent()
+                    touchHookInstalled = true
+                }
+                let method = class_getClassMethod(ScreenGraphRuntime.self, #selector(touchBegan(_:y:)))!
+                return UInt(bitPattern: unsafeBitCast(method_getImplementation(method), to: Int.self))
+            }
+            
+            @objc public static func removeTouchHook() {
+                if touchHookInstalled {
+                    exchangeSendEvent()
+                    touchHookInstalled = false
+                }
+            }
+        }
         
-    def __call__(self, *args, **kwds):
-        if self.instance == None:
-            self.instance = self.klass(*args, **kwds)
-        return self.instance
+        extension ScreenGraphRuntime {
+            static let visibleKey = UnsafeMutablePointer<CChar>.allocate(capacity: %(key_size)i)
+            static var visibleKeyTracking = false
+            
+            static func updateVisibleKey() {
+                let key = visibleViewControllerKey().utf8CString
+                key.withUnsafeBufferPointer { buffer in
+                    visibleKey.assign(from: buffer.baseAddress!, count: min(buffer.count, %(key_size)i))
+                }
+                visibleKey[%(key_size)i - 1] = 0
+            }
+            
+            static func exchangeViewDidAppear() {
+                let original = class_getInstanceMethod(UIViewController.self, #selector(UIViewController.viewDidAppear(_:)))!
+                let hook = class_getInstanceMethod(UIViewController.self, #selector(UIViewController.screengraph_viewDidAppear(_:)))!
+                method_exchangeImplementations(original, hook)
+            }
+            
+            @objc public static func installVisibleKeyTracking() -> UInt {
+                if !visibleKeyTracking {
+                    exchangeViewDidAppear()
+                    visibleKeyTracking = true
+                }
+                updateVisibleKey()
+                return UInt(bitPattern: visibleKey)
+            }
+            
+            @objc public static func removeVisibleKeyTracking() {
+                if visibleKeyTracking {
+                    exchangeViewDidAppear()
+                    visibleKeyTracking = false
+                }
+            }
+        }
+        
+        extension ScreenGraphRuntime {
+            static var recorder: UnsafeMutableRawPointer? = nil
+            static var recorderCapacity = 0
+            static var recorderSequence: UInt32 = 0
+            static var recorderScreenshots: String? = nil
+            static var recorderExtension = "png"
+            static let recorderLock = NSLock()
+            
+            // See Recorder for the file format.
+            @objc public static func startRecorder(_ path: NSString, capacity: Int, screenshots: NSString?, fileExtension: NSString) -> Bool {
+                stopRecorder()
+                let fd = open(path.fileSystemRepresentation, O_RDWR)
+                if fd < 0 {
+                    return false
+                }
+                defer { close(fd) }
+                guard let memory = mmap(nil, %(recorder_offset)i + capacity, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0), memory != MAP_FAILED else {
+                    return false
+                }
+                recorderLock.lock()
+                defer { recorderLock.unlock() }
+                recorder = memory
+                recorderCapacity = capacity
+                recorderSequence = 0
+                recorderScreenshots = screenshots as String?
+                recorderExtension = fileExtension as String
+                if !touchHookInstalled {
+                    exchangeSendEvent()
+                    touchHookInstalled = true
+                }
+                return true
+            }
+            
+            @objc public static func stopRecorder() {
+                recorderLock.lock()
+                defer { recorderLock.unlock() }
+                if let memory = recorder {
+                    munmap(memory, %(recorder_offset)i + recorderCapacity)
+                    recorder = nil
+                }
+            }
+            
+            // For apps to tag call sites without stopping, e.g.
+            // (NSClassFromString("ScreenGraphRuntime") as AnyObject?)?.perform(Selector(("mark:")), with: "checkout")
+            @objc public static func mark(_ tag: NSString) {
+                record(%(recorder_mark)i, 0, 0, tag as String)
+            }
+            
+            static func record(_ kind: UInt8, _ x: Double, _ y: Double, _ text: String, screenshot: Bool = false) {
+                recorderLock.lock()
+                defer { recorderLock.unlock() }
+                guard let memory = recorder else {
+                    return
+                }
+                let sequence = recorderSequence
+                recorderSequence += 1
+                var flags: UInt8 = 0
+                if screenshot, let prefix = recorderScreenshots, let window = UIApplication.shared.keyWindow,
+                    self.screenshot(window, "\\(prefix)\\(sequence).\\(recorderExtension)") == "saved" {
+                    flags |= %(recorder_saved)i
+                }
+                let key = Array(String(cString: visibleKey).utf8.prefix(%(key_size)i))
+                let text = Array(text.utf8.prefix(%(key_size)i))
+                var bytes: [UInt8] = []
+                func append<T>(_ value: T) {
+                    withUnsafeBytes(of: value) { bytes.append(contentsOf: $0) }
+                }
+                append(UInt16(%(recorder_header)i + key.count + text.count))
+                append(kind)
+                append(flags)
+                append(sequence)
+                append(Date().timeIntervalSince1970)
+                append(Float(x))
+                append(Float(y))
+                append(UInt16(key.count))
+                append(UInt16(text.count))
+                bytes += key
+                bytes += text
+                let position = (memory + 16).assumingMemoryBound(to: UInt64.self)
+                let start = position.pointee
+                for (index, byte) in bytes.enumerated() {
+                    memory.storeBytes(of: byte, toByteOffset: %(recorder_offset)i + Int((start + UInt64(index)) %% UInt64(recorderCapacity)), as: UInt8.self)
+                }
+                OSMemoryBarrier() // the record before the position that publishes it
+                position.pointee = start + UInt64(bytes.count)
+            }
+        }
+        
+        extension UIViewController {
+            @objc func screengraph_viewDidAppear(_ animated: Bool) {
+                screengraph_viewDidAppear(animated) // original implementation, methods are exchanged
+                ScreenGraphRuntime.updateVisibleKey()
+            }
+        }
+        
+        extension UIApplication {
+            @objc func screengraph_sendEvent(_ event: UIEvent) {
+                if event.type == .touches, let touch = event.allTouches?.first, touch.phase == .began {
+                    let point = touch.location(in: touch.window)
+                    ScreenGraphRuntime.touchLocation[0] = Double(point.x)
+                    ScreenGraphRuntime.touchLocation[1] = Double(point.y)
+                    ScreenGraphRuntime.record(%(recorder_touch)i, Double(point.x), Double(point.y), "", screenshot: true)
+                    ScreenGraphRuntime.touchBegan(Double(point.x), y: Double(point.y))
+                }
+                screengraph_sendEvent(event) // original implementation, methods are exchanged
+            }
+        }
+    """ % {
+        'size': 40, 
+        'color': 'red', 
+        'duration': 0.75,
+        'key_size': key_size,
+        'recorder_offset': 64, # Recorder.offset
+        'recorder_header': 28, # Recorder.record.size
+        'recorder_touch': 1, # Recorder.touch
+        'recorder_mark': 2, # Recorder.mark
+        'recorder_saved': 1, # Recorder.saved
+    }
+    
+    def __init__(self, debugger, timeout=2.0, target=None):
+        self.debugger = debugger
+        self.target = target or debugger.GetSelectedTarget() # the app this runtime is installed into
+        self.visible_key = 0 # address of the visible view controller key, when tracked by the app
+        self.stop = None # id of the stop shared values are for
+        self.stop_values = {}
+        
+        self.options = lldb.SBExpressionOptions()
+        self.options.SetLanguage(lldb.eLanguageTypeObjC)
+        self.options.SetTimeoutInMicroSeconds(int(timeout * 1000000))
+        self.options.SetTryAllThreads(False)
+        self.options.SetIgnoreBreakpoints(True)
+        self.options.SetUnwindOnError(True)
+    
+    def shared(self, process):
+        """Values shared by the states of one stop (visible key, screenshot), cleared when the process stops again."""
+        stop = process.GetStopID()
+        if stop != self.stop:
+            self.stop = stop
+            self.stop_values = {}
+        return self.stop_values
+    
+    def selected_frame(self):
+        return self.target.GetProcess().GetSelectedThread().GetSelectedFrame()
+    
+    def call(self, message, frame=None):
+        with stats.timed('expression'):
+            return (frame or self.selected_frame()).EvaluateExpression(
+                '[(Class)NSClassFromString(@"ScreenGraphRuntime") %s]' % message,
+                self.options,
+            )
+    
+    def install(self):
+        frame = self.selected_frame()
+        options = lldb.SBExpressionOptions()
+        options.SetLanguage(lldb.eLanguageTypeSwift)
+        value = frame.EvaluateExpression(Runtime.source, options)
+        if value.GetError().Fail():
+            print('Screengraph could not install its runtime: ' + str(value.GetError()))
+    
+    def configure_screenshots(self, scale=1.0, max_size=0, format='png', quality=0.8, thumbnail_size=0, keep_original=False):
+        self.call('configure:%f maxSize:%i format:@"%s" quality:%f thumbnailSize:%i keepOriginal:%s' % (
+            scale,
+            max_size,
+            format,
+            quality,
+            thumbnail_size,
+            'YES' if keep_original else 'NO',
+        ))
+    
+    def capture(self, state, path=None, raw=False):
+        """
+        Sets the state's visible view controller key and screenshot status, in
+        a single call into the app. With raw, the screen is only rendered into
+        a bitmap in the app, see read_pixels.
+        """
+        touch = isinstance(state, TouchState)
+        if raw:
+            message = 'captureRaw:%f y:%f highlight:%s' % (
+                state.x if touch else 0,
+                state.y if touch else 0,
+                'YES' if touch else 'NO',
+            )
+        else:
+            message = 'capture:%s x:%f y:%f highlight:%s' % (
+                ('@"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')) if path else 'nil',
+                state.x if touch else 0,
+                state.y if touch else 0,
+                'YES' if touch and path else 'NO',
+            )
+        value = self.call(message, state.frame)
+        result = value.GetObjectDescription() or ''
+        if '\t' in result:
+            state.key, state.screenshot = result.rsplit('\t', 1)
+            self.shared(state.frame.GetThread().GetProcess())['key'] = state.key
+        else:
+            state.key, state.screenshot = 'unknown', 'error: ' + str(value.GetError())
+        debug_print('capture: ' + result)
+    
+    def visible_view_controller(self, state):
+        if state.key is None: # not captured along with a screenshot
+            process = state.frame.GetThread().GetProcess()
+            key = self.shared(process).get('key') or self.read_visible_key(process)
+            if key is not None:
+                state.key = key
+                return state.key
+            self.capture(state)
+        return state.key
+    
+    def read_visible_key(self, process):
+        """Returns the key kept by visible key tracking, None if not tracking; read once per stop."""
+        if self.visible_key:
+            shared = self.shared(process)
+            if 'key' not in shared:
+                error = lldb.SBError()
+                key = process.ReadCStringFromMemory(self.visible_key, Runtime.key_size, error)
+                if error.Fail():
+                    return None
+                shared['key'] = key.decode('utf-8', 'replace').encode('utf-8')
+            return shared['key']
+        return None
+    
+    def install_visible_key_tracking(self):
+        """
+        Swizzles -[UIViewController viewDidAppear:] so the app keeps the
+        visible view controller's key in memory, for visible_view_controller
+        to read instead of calling into the app.
+        """
+        self.visible_key = self.call('installVisibleKeyTracking').GetValueAsUnsigned()
+    
+    def remove_visible_key_tracking(self):
+        if self.visible_key:
+            self.call('removeVisibleKeyTracking')
+            self.visible_key = 0
+    
+    def read_pixels(self, state):
+        """Returns (width, height, bytes per row, BGRA data) of a raw capture."""
+        _, address, width, height, stride = state.screenshot.split()
+        error = lldb.SBError()
+        data = state.frame.GetThread().GetProcess().ReadMemory(int(address), int(height) * int(stride), error)
+        if error.Fail():
+            raise RuntimeError('Screengraph could not read screenshot: ' + str(error))
+        return int(width), int(height), int(stride), data
+    
+    def install_touch_hook(self):
+        """
+        Swizzles -[UIApplication sendEvent:] so that touch-began events are
+        filtered in the app; returns the address to break on, or 0.
+        """
+        self.touch_location = self.call('touchLocationAddress').GetValueAsUnsigned()
+        return self.call('installTouchHook').GetValueAsUnsigned()
+    
+    def remove_touch_hook(self):
+        self.call('removeTouchHook')
+    
+    def start_recorder(self, filename, capacity, screenshots=None, extension='png'):
+        """
+        Has the app append touches and marks to the ring buffer mapped from
+        filename, see Recorder. With screenshots, a path prefix, the app also
+        saves a screenshot on each touch. Returns whether the recorder started.
+        """
+        return bool(self.call('startRecorder:@"%s" capacity:%i screenshots:%s fileExtension:@"%s"' % (
+            filename.replace('\\', '\\\\').replace('"', '\\"'),
+            capacity,
+            ('@"%s"' % screenshots.replace('\\', '\\\\').replace('"', '\\"')) if screenshots else 'nil',
+            extension,
+        )).GetValueAsUnsigned())
+    
+    def stop_recorder(self):
+        self.call('stopRecorder')
+    
+    def read_touch_location(self, process):
+        error = lldb.SBError()
+        data = process.ReadMemory(self.touch_location, 16, error)
+        if error.Fail():
+            raise RuntimeError('Screengraph could not read touch location: ' + str(error))
+        return struct.unpack('=dd', data)
 
 
 #-- Outputs
 
 class Output:
     
+    def prepare(self, state):
+        """Called while the process is stopped; only work that needs the process belongs here."""
+        pass
+    
     def process(self, state):
+        """Called on the writer thread, after the process has been resumed."""
         raise NotImplementedError
+    
+    def restart(self):
+        """Called before the states of another trace (e.g. another target's shard), not to be linked to the previous ones."""
+        pass
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.flush()
 
 
 class TextOutput(Output):
     
-    def __init__(self, directory):
+    def __init__(self, directory, append=True):
         self.filename = os.path.join(directory, 'trace.txt')
+        self.file = open(self.filename, 'a+' if append else 'w')
         
     def process(self, state):
-        with open(self.filename, 'a+') as f:
-            f.write(str(state) + '\n')
+        self.file.write(str(state) + '\n')
+    
+    def flush(self):
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+
+class ScreenshotStore:
+    """
+    Content-addressed screenshots: each distinct screen is stored once as
+    screenshots/<hash>.<ext> (and screenshots/<hash>.full.<ext> for
+    full-resolution originals of thumbnails). Per-state names
+    (screenshot_<id>.<ext>) are symlinks to it, and are also listed in
+    screenshots.manifest.
+    """
+    
+    def __init__(self, directory, extension='png'):
+        self.directory = directory
+        self.extension = extension
+        self.objects = os.path.join(directory, 'screenshots')
+        make_directory_if_not_exist(self.objects)
+        self.digests = set() # objects written (or being written) by this session
+        self.manifest = open(os.path.join(directory, 'screenshots.manifest'), 'a')
+    
+    def object(self, digest, original=False):
+        return os.path.join('screenshots', '%s%s.%s' % (digest, '.full' if original else '', self.extension))
+    
+    def path(self, digest, original=False):
+        return os.path.join(self.directory, self.object(digest, original))
+    
+    def add(self, digest, original=False):
+        """Returns whether the object (and its original, if required) still has to be written."""
+        if digest in self.digests:
+            return False
+        self.digests.add(digest)
+        # objects left by earlier sessions in the same directory are only reused when all their files are there
+        return not (os.path.exists(self.path(digest)) and (not original or os.path.exists(self.path(digest, original=True))))
+    
+    def link(self, state, filename, digest):
+        """Points a state's screenshot file name at its object, and records it in the manifest."""
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        os.symlink(self.object(digest), filename)
+        self.manifest.write('%s\t%s\n' % (state.identifier, self.object(digest)))
+        state.image = self.object(digest)
+    
+    def flush(self):
+        self.manifest.flush()
+    
+    def close(self):
+        self.manifest.close()
+
+
+class BKTree(object):
+    """Burkhard-Keller tree of integers under the Hamming distance, for nearest-neighbour lookups."""
+    
+    __slots__ = ('root', 'size')
+    
+    def __init__(self):
+        self.root = None # [value, payload, {distance: child}]
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def add(self, value, payload):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, payload, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, payload, {}]
+                return
+            node = child
+    
+    def nearest(self, value, threshold):
+        """Returns (distance, payload) of the closest value within threshold, or None."""
+        best = None
+        radius = threshold
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                best = (distance, node[1])
+                radius = distance - 1 # only look for strictly closer values
+                if radius < 0:
+                    break
+            for d, child in node[2].iteritems():
+                if distance - radius <= d <= distance + radius:
+                    stack.append(child)
+        return best
+
+
+class ScreenIdentity:
+    """
+    Identifies screens by the perceptual hash of their screenshots: a
+    screenshot within threshold bits of a known screen's is that screen,
+    otherwise it is a new one (S0, S1, ...).
+    """
+    
+    def __init__(self, threshold=6):
+        self.threshold = threshold
+        self.tree = BKTree()
+        self.screens = {} # screenshot digest -> screen
+    
+    def identify(self, digest, hash):
+        """Returns the screen of a screenshot, hash being a function computing its perceptual hash."""
+        screen = self.screens.get(digest)
+        if screen is None:
+            with stats.timed('screen identity'):
+                value = hash()
+                nearest = self.tree.nearest(value, self.threshold)
+                if nearest:
+                    screen = nearest[1]
+                else:
+                    screen = 'S%i' % len(self.tree)
+                    self.tree.add(value, screen)
+            self.screens[digest] = screen
+        return screen
 
 
 class ScreenshotOutput(Output):
     
-    def __init__(self, directory, debugger, on_touch, on_breakpoint):
+    modes = ('raw', 'app')
+    formats = ('png', 'jpeg', 'heic')
+    
+    class Scheduler:
+        """
+        Decides which states get a screenshot: at most rate per second, in
+        bursts of up to burst, and at most one per screen key every
+        min_interval seconds. Screen transitions (a key other than the last
+        screenshot's) skip the interval, and half of the bucket (at most
+        all but one token) is kept for them.
+        """
+        
+        def __init__(self, rate=0, burst=5, min_interval=0):
+            self.rate = rate # screenshots per second, 0 for no limit
+            self.burst = max(burst, 1)
+            self.min_interval = min_interval # seconds
+            self.tokens = float(self.burst)
+            self.reserve = min(1 + self.burst / 2.0, self.burst) # tokens needed for a screenshot of the same screen
+            self.refilled = timer()
+            self.last_key = None # of the last screenshot
+            self.last_shots = {} # screen key -> time of the last screenshot
+        
+        def admit(self, key, now=None):
+            """Returns None if the screenshot should be taken, otherwise why it is dropped."""
+            now = timer() if now is None else now
+            transition = (key != self.last_key)
+            if not transition and self.min_interval and now - self.last_shots.get(key, -self.min_interval) < self.min_interval:
+                return 'interval'
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens < (1 if transition else self.reserve):
+                    return 'rate'
+                self.tokens -= 1
+            self.last_key = key
+            self.last_shots[key] = now
+            return None
+    
+    def __init__(self, directory, runtime, on_touch, on_breakpoint, mode='raw', workers=2,
+                 scale=1.0, max_size=0, format='png', quality=0.8, thumbnail_size=0, keep_originals=False,
+                 rate=0, burst=5, min_interval=0, identity_threshold=-1):
         self.directory = directory
-        self.debugger = debugger
+        self.runtime = runtime
         self.on_touch = on_touch
         self.on_breakpoint = on_breakpoint
+        self.mode = mode # 'raw': render in the app, encode on the host; 'app': encode and write in the app
+        self.format = format
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size # graph nodes reference thumbnails of at most this size, 0 for none
+        self.keep_originals = keep_originals # also store full-resolution screenshots when using thumbnails
+        # digests cover the encoding settings, so sessions with different settings in one directory do not share objects
+        self.variant = '%s:%s:%i:%i:' % (format, quality, thumbnail_size, keep_originals)
         
-        self.setup_touch_highlighting(debugger)
-        self.setup_screenshot(debugger)
-    
-    def filename(self, state):
-        return os.path.join(self.directory, 'screenshot_%s.png' % state.identifier)
-    
-    def setup_touch_highlighting(self, debugger):
-        frame = self.debugger.GetSelectedTarget().GetProcess().GetSelectedThread().GetSelectedFrame()
-        options = lldb.SBExpressionOptions()
-        options.SetLanguage(lldb.eLanguageTypeSwift)
-        expr = """
-            import UIKit
-            extension UIWindow {
-                public func highlight(_ point: CGPoint) {
-                    let circleView = UIView(frame: CGRect(x: 0, y: 0, width: %(size)i, height: %(size)i))
-                    circleView.center = point
-                    circleView.alpha = 0.5
-                    circleView.layer.cornerRadius = %(size)i/2
-                    circleView.backgroundColor = UIColor.%(color)s
-                    circleView.isUserInteractionEnabled = false
-                    self.addSubview(circleView)
-                    UIView.animate(withDuration: %(duration)f, delay: 0.0, options: [], animations: {
-                        circleView.alpha = 0.0
-                    }, completion: { (finished: Bool) in
-                        circleView.removeFromSuperview()
-                    })
-                }
-            }
-        """ % {
-            'size': 40, 
-            'color': 'red', 
-            'duration': 0.75
-        }
-        frame.EvaluateExpression(expr, options)
+        if mode == 'raw' and format == 'heic':
+            raise ValueError('HEIC screenshots are only encoded in the app, use --screenshot-mode=app')
+        if mode == 'raw' and format == 'jpeg' and not Image:
+            raise ValueError('encoding JPEG screenshots on the host requires PIL, use --screenshot-mode=app')
+        if runtime and (rate or min_interval) and not runtime.visible_key:
+            # the scheduler needs the key before the screenshot; without tracking, that's another call into the app
+            raise ValueError('limiting screenshots requires the visible view controller tracked by the app, use --vc-tracking=push')
+        if mode == 'app' and identity_threshold >= 0 and not Image:
+            raise ValueError('identifying screens from screenshots saved by the app requires PIL, use --screenshot-mode=raw')
         
-    def setup_screenshot(self, debugger):
-        frame = self.debugger.GetSelectedTarget().GetProcess().GetSelectedThread().GetSelectedFrame()
-        options = lldb.SBExpressionOptions()
-        options.SetLanguage(lldb.eLanguageTypeSwift)
-        expr = """
-            import UIKit
-            extension UIWindow {
-                public func screenshot(_ path: String) {
-                    let view = self.screen.snapshotView(afterScreenUpdates: true)
-                    UIGraphicsBeginImageContext(view.bounds.size)
-                    view.drawHierarchy(in: view.bounds, afterScreenUpdates: true)
-                    if let image = UIGraphicsGetImageFromCurrentImageContext(),
-                        let data = image.pngData() {
-                        if let fileURL = URL(string: path) {
-                            do {
-                                try data.write(to: fileURL)
-                                print("Screenshot saved")
-                            } catch {
-                                print("Error saving screenshot:", error)
-                            }
-                        } else {
-                            print("Screengraph could not get valid file path")
-                        }
-                    } else {
-                        print("Screengraph could not take a screenshot")
-                    }
-                    UIGraphicsEndImageContext()
-                }
-            }
-        """
-        frame.EvaluateExpression(expr, options)
+        if runtime:
+            runtime.configure_screenshots(scale, max_size, format, quality, thumbnail_size, keep_originals)
         
-    def process(self, state):
+        # threads rather than processes, which would fork the debugger; zlib releases
+        # the GIL while compressing, but the pure-Python swizzle and downsample hold it,
+        # so workers mostly overlap encoding with compression and the writer's I/O
+        self.pool = multiprocessing.pool.ThreadPool(workers) if mode == 'raw' else None
+        self.pending = collections.deque()
+        self.store = ScreenshotStore(directory, extension=('jpg' if format == 'jpeg' else format))
+        self.scheduler = ScreenshotOutput.Scheduler(rate, burst, min_interval) if rate or min_interval else None
+        self.last_digest = None
+        self.last_digests = {} # screen key -> digest of its last screenshot, for dropped screenshots
+        # screens identified by screenshot rather than view controller, -1 for none
+        self.identity = ScreenIdentity(identity_threshold) if identity_threshold >= 0 else None
+    
+    def filename(self, state, thumbnail=False):
+        return os.path.join(self.directory, 'screenshot_%s%s.%s' % (
+            state.identifier,
+            '_thumb' if thumbnail else '',
+            self.store.extension,
+        ))
+        
+    def prepare(self, state):
+        if state.frame is None:
+            return # recorded by the app, which also took the screenshot, see Recorder
         if (self.on_breakpoint and isinstance(state, BreakpointState)) \
             or (self.on_touch and isinstance(state, TouchState)):
+            shared = self.runtime.shared(state.frame.GetThread().GetProcess())
+            if shared.get('screenshot'): # taken for another state of this stop
+                self.runtime.visible_view_controller(state)
+                state.screenshot = 'shared'
+                return
+            shared['screenshot'] = True
+            if self.scheduler:
+                reason = self.scheduler.admit(self.runtime.visible_view_controller(state))
+                if reason:
+                    state.screenshot = 'dropped'
+                    stats.count('screenshot dropped (%s)' % reason)
+                    return
             self.screenshot(state)
+    
+    def process(self, state):
+        if state.pixels:
+            pixels = state.pixels
+            state.pixels = None
+            digest = hashlib.sha1(self.variant + '%ix%i:' % pixels[:2] + pixels[3]).hexdigest()
+            if self.store.add(digest, original=self.originals()):
+                self.pending.append((digest, self.pool.apply_async(self.encode, (digest, pixels))))
+            self.link(state, digest)
+            if self.identity:
+                state.key = self.identity.identify(digest, lambda: dhash(*pixels))
+            while self.pending and self.pending[0][1].ready():
+                self.collect(*self.pending.popleft())
         
-    def screenshot(self, state):
-        highlight = ('window.highlight(CGPoint(x: %i, y: %i))' % (state.x, state.y)) if \
-            isinstance(state, TouchState) else ''
+        elif state.screenshot in ('dropped', 'shared'): # by the scheduler, or with another state of the stop: use the screen's last screenshot
+            digest = self.last_digests.get(state.key, self.last_digest)
+            if digest:
+                self.store.link(state, self.filename(state), digest)
+                if self.identity:
+                    state.key = self.identity.screens[digest]
         
-        options = lldb.SBExpressionOptions()
-        options.SetLanguage(lldb.eLanguageTypeSwift)
-        expr = """
-            import UIKit
-            if let window = UIApplication.shared.keyWindow {
-                %(highlight)s
-                window.screenshot("file://%(filename)s")
-            } else {
-                print("Screengraph could not get a window")
-            }
-        """ % {
-            'filename': self.filename(state),
-            'highlight': highlight
-        }
-        state.frame.EvaluateExpression(expr, options)
+        elif state.screenshot == 'saved': # written by the app
+            filename = self.filename(state, thumbnail=bool(self.thumbnail_size))
+            files = [(filename, False)]
+            if self.originals():
+                files.append((self.filename(state), True))
+            # with originals, hash the original: different screens can have the same thumbnail
+            with open(files[-1][0], 'rb') as f:
+                digest = hashlib.sha1(self.variant + f.read()).hexdigest()
+            new = self.store.add(digest, original=self.originals())
+            for name, original in files:
+                if new:
+                    os.rename(name, self.store.path(digest, original))
+                else:
+                    os.remove(name)
+            self.link(state, digest)
+            if self.identity:
+                state.key = self.identity.identify(digest, lambda: dhash_file(self.store.path(digest)))
+    
+    def originals(self):
+        return bool(self.thumbnail_size and self.keep_originals)
+    
+    def link(self, state, digest):
+        self.store.link(state, self.filename(state), digest)
+        self.last_digest = self.last_digests[state.key] = digest
+    
+    def collect(self, digest, result):
+        """Waits for an encoding; on errors, which belong to an earlier state, reports them and forgets the object."""
+        try:
+            result.get()
+        except Exception:
+            traceback.print_exc()
+            stats.count('screenshot encode failed')
+            self.store.digests.discard(digest) # written again by the next state with this screen
+    
+    def encode(self, digest, pixels):
+        with stats.timed('encode'):
+            self.write(digest, pixels)
+    
+    def write(self, digest, pixels):
+        if self.thumbnail_size:
+            write_image(self.store.path(digest), *downsample(*pixels, size=self.thumbnail_size), format=self.format, quality=self.quality)
+            if self.keep_originals:
+                write_image(self.store.path(digest, original=True), *pixels, format=self.format, quality=self.quality)
+        else:
+            write_image(self.store.path(digest), *pixels, format=self.format, quality=self.quality)
+        
+    def screenshot(self, state):
+        if self.mode == 'raw':
+            self.runtime.capture(state, raw=True)
+            if state.screenshot.startswith('raw '):
+                state.pixels = self.runtime.read_pixels(state)
+                return
+        else:
+            self.runtime.capture(state, path=self.filename(state))
+            if state.screenshot == 'saved':
+                return
+        print('Screengraph could not take a screenshot: ' + state.screenshot)
+    
+    def flush(self):
+        while self.pending:
+            self.collect(*self.pending.popleft())
+        self.store.flush()
+    
+    def close(self):
+        self.flush()
+        self.store.close()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
 
 
 class GraphvizOutput(Output):
     
-    class Edge:
-        def __init__(self, src, dst, labelpos=None):
-            self.src = src
-            self.dst = dst
-            self.labelpos = labelpos
-            
-            self.label = textwrap.fill(str(self.src.state).replace('"', '\\"')) if self.labelpos == 'edge' else ''
+    class Graph(object):
+        """Indexed graph store: nodes are integer ids into parallel record arrays."""
         
-        def __str__(self):
-            return '\n\tN%s -> N%s [label="%s"];' % (
-                self.src.state.identifier, 
-                self.dst.state.identifier,
-                self.label,
-            )
-
-    class Node:
-        def __init__(self, state, labelpos=None):
-            self.state = state
-            self.labelpos = labelpos
-            self.edges = []
-            
-            self.label = textwrap.fill(str(self.state).replace('"', '\\"')) if self.labelpos == 'node' else ''
-            self.image_filename = ('screenshot_%s.png' % self.state.identifier) if isinstance(self.state, TouchState) else ''
-
-        def add_edge(self, node, labelpos=None):
-            if not node in [edge.dst for edge in self.edges]:
-                self.edges.append(GraphvizOutput.Edge(self, node, labelpos or self.labelpos))
-            
-        def __str__(self):
-            return '\n\tN%s [image="%s", label="%s"];' % (
-                self.state.identifier,
-                self.image_filename,
-                self.label,
-            )
-
-    def __init__(self, directory, reentry, labelpos='node'):
+        spilled = -2 # cluster of nodes already written to the spill file, only kept as edge ends
+        
+        __slots__ = ('identifiers', 'clusters', 'images', 'labels', 'hits', 'last_identifiers', 'keys', 'members',
+                     'adjacency', 'edge_labels', 'spans')
+        
+        def __init__(self):
+            self.identifiers = [] # node -> (first) state identifier
+            self.clusters = array.array('l') # node -> cluster, -1 if none, Graph.spilled
+            self.images = [] # node -> image filename
+            self.labels = [] # node -> raw label text
+            self.hits = array.array('l') # node -> number of states
+            self.last_identifiers = {} # node -> last state identifier, when hit more than once
+            self.keys = {} # cluster key -> cluster
+            self.members = [] # cluster -> array of nodes
+            self.adjacency = {} # src node -> {dst node: count}
+            self.edge_labels = {} # (src, dst) -> raw label text
+            self.spans = {} # (src, dst) -> [first, last] state identifiers
+        
+        def __len__(self):
+            return len(self.identifiers)
+        
+        def cluster(self, key):
+            cluster = self.keys.get(key)
+            if cluster is None:
+                cluster = self.keys[key] = len(self.members)
+                self.members.append(array.array('l'))
+            return cluster
+        
+        def add_node(self, identifier, cluster=-1, image='', label=''):
+            node = len(self.identifiers)
+            self.identifiers.append(identifier)
+            self.clusters.append(cluster)
+            self.images.append(image)
+            self.labels.append(label)
+            self.hits.append(1)
+            if cluster >= 0:
+                self.members[cluster].append(node)
+            return node
+        
+        def hit(self, node, identifier):
+            self.hits[node] += 1
+            self.last_identifiers[node] = identifier
+        
+        def add_edge(self, src, dst, label='', identifier=None):
+            dsts = self.adjacency.get(src)
+            if dsts is None:
+                dsts = self.adjacency[src] = {}
+            count = dsts.get(dst, 0) + 1
+            dsts[dst] = count
+            if count == 1 and label:
+                self.edge_labels[(src, dst)] = label
+            if identifier is not None:
+                span = self.spans.get((src, dst))
+                if span is None:
+                    self.spans[(src, dst)] = [identifier, identifier]
+                else:
+                    span[1] = identifier
+            return count
+        
+        def edges(self):
+            for src in xrange(len(self.identifiers)):
+                dsts = self.adjacency.get(src)
+                if dsts:
+                    for dst in sorted(dsts):
+                        yield src, dst, dsts[dst]
+    
+    class Renderer:
+        """
+        Renders graph.dot with Graphviz in a separate process. Requests are
+        coalesced: at most one render is in flight, the newest graph wins, and
+        unchanged graphs are not rendered again.
+        """
+        
+        def __init__(self, filename, formats):
+            self.filename = filename
+            self.formats = formats # e.g. ['png', 'svg'] or ['png:gd']
+            self.requested = False
+            self.closed = False
+            self.digest = None
+            self.condition = threading.Condition()
+            self.thread = threading.Thread(target=self.run, name='screengraph renderer')
+            self.thread.daemon = True
+            self.thread.start()
+        
+        def request(self):
+            with self.condition:
+                self.requested = True
+                self.condition.notify()
+        
+        def run(self):
+            while True:
+                with self.condition:
+                    while not self.requested and not self.closed:
+                        self.condition.wait()
+                    if not self.requested:
+                        return
+                    self.requested = False
+                try:
+                    self.render()
+                except Exception:
+                    traceback.print_exc()
+        
+        def render(self):
+            with open(self.filename, 'rb') as f:
+                dot = f.read()
+            digest = hashlib.sha1(dot).hexdigest()
+            if digest == self.digest:
+                return
+            directory = os.path.dirname(self.filename)
+            rendered = True
+            for format in self.formats:
+                output = os.path.splitext(self.filename)[0] + '.' + format.split(':')[0]
+                with stats.timed('render ' + format):
+                    try:
+                        process = subprocess.Popen(
+                            ['dot', '-T' + format, '-o', output + '.tmp'],
+                            stdin=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=directory, # image paths are relative
+                        )
+                    except OSError, e:
+                        print('Screengraph could not run Graphviz (dot): ' + str(e))
+                        self.formats = []
+                        return
+                    _, error = process.communicate(dot)
+                if process.returncode == 0:
+                    os.rename(output + '.tmp', output)
+                else:
+                    print('Screengraph could not render %s: %s' % (os.path.basename(output), error.strip()))
+                    if os.path.exists(output + '.tmp'):
+                        os.remove(output + '.tmp')
+                    rendered = False
+            if rendered: # otherwise, try again on the next request
+                self.digest = digest
+        
+        def close(self):
+            """Waits for the last requested render."""
+            with self.condition:
+                self.closed = True
+                self.condition.notify()
+            self.thread.join()
+    
+    def __init__(self, directory, reentry, labelpos='node', flush_interval=0, runtime=None, render=None, aggregate=False, top_edges=0,
+                 max_nodes=0):
         self.filename = os.path.join(directory, 'graph.dot')
+        self.runtime = runtime
         self.reentry = reentry
+        self.aggregate = aggregate # one node per screen key, one edge per transition
+        self.top_edges = top_edges # when aggregating, only keep the most frequent transitions, 0 for all
         self.labelpos = labelpos # 'edge' or 'node' or None
+        self.flush_interval = flush_interval # seconds, 0 to only write on flush/stop
+        self.max_nodes = max_nodes # nodes kept in memory before older ones are spilled to graph.spill, 0 for no limit
         
-        self.root = None
-        self.last = None
+        self.spill_filename = os.path.join(directory, 'graph.spill')
+        if os.path.exists(self.spill_filename):
+            os.remove(self.spill_filename)
+        self.spilled = False
+        self.tails = {} # cluster -> identifier of its last spilled node
         
-        self.nodes = collections.OrderedDict()
+        self.graph = GraphvizOutput.Graph()
+        self.last = None
+        self.last_label = ''
+        self.screens = {} # screen key -> node, when aggregating
+        self.last_write = time.time()
+        self.dirty = False
+        self.renderer = GraphvizOutput.Renderer(self.filename, render) if render else None
         
+    def prepare(self, state):
+        if self.reentry or self.aggregate:
+            if isinstance(state, TouchState):
+                self.runtime.visible_view_controller(state)
+    
     def process(self, state):
+        if state.key is None:
+            state.key = str(state) # breakpoint description, symbolicated on this thread
         
-        if self.reentry:
-            if isinstance(state, TouchState):
-                key = self.visible_view_controller(state.frame)
+        if self.aggregate:
+            node = self.screens.get(state.key)
+            if node is None:
+                node = self.screens[state.key] = self.graph.add_node(state.identifier, -1, state.image or '', state.key)
             else:
-                key = str(state.frame)
-                
-            node = GraphvizOutput.Node(state, labelpos=self.labelpos)
-            if key not in self.nodes.keys():
-                self.nodes[key] = []
-            self.nodes[key].append(node)
-
+                self.graph.hit(node, state.identifier)
+            if self.last is not None:
+                self.graph.add_edge(self.last, node, identifier=state.identifier)
+            self.last = node
+            self.dirty = True
+            if self.flush_interval and time.time() - self.last_write >= self.flush_interval:
+                self.write()
+            return
+        
+        if self.reentry:
+            cluster = self.graph.cluster(state.key)
+        
         else: # no reentry
-            node = GraphvizOutput.Node(state, labelpos=self.labelpos)
-
-        if not self.root:
-            self.root = node
+            cluster = -1
         
-        if self.last:
-            if self.last == node: # edge loops on same node
-                self.last.add_edge(node, labelpos='edge')
-            else:
-                self.last.add_edge(node)
+        image_filename = state.image or ''
+        label = str(state) if self.labelpos == 'node' else ''
+        node = self.graph.add_node(state.identifier, cluster, image_filename, label)
+        
+        if self.last is not None:
+            self.graph.add_edge(self.last, node, self.last_label)
         
         self.last = node
+        self.last_label = str(state) if self.labelpos == 'edge' else ''
+        self.dirty = True
         
-        with open(self.filename, 'w+') as f:
-            f.write(self.output)
+        if self.max_nodes and len(self.graph) > self.max_nodes:
+            self.spill()
         
-        #TODO generate png from graph automatically
-
-    def visible_view_controller(self, frame):
-        options = lldb.SBExpressionOptions()
-        options.SetLanguage(lldb.eLanguageTypeSwift)
-        value = frame.EvaluateExpression('''
-            import UIKit
-            func getVisibleViewController(_ rootViewController: UIViewController?) -> UIViewController? {
-                let viewController = rootViewController ?? UIApplication.shared.keyWindow?.rootViewController
-                if let presented = viewController?.presentedViewController {
-                    return getVisibleViewController(presented)
-                }
-                if let navigationController = viewController as? UINavigationController {
-                    return getVisibleViewController(navigationController.viewControllers.last!)
-                }
-                if let tabBarController = viewController as? UITabBarController {
-                    return getVisibleViewController(tabBarController.selectedViewController!)
-                }
-                return viewController
-            }
-            let viewController = getVisibleViewController(nil)
-            viewController?.title ?? (viewController != nil ? NSStringFromClass(type(of:viewController!)) : "unknown")
-        ''', options).GetObjectDescription()
-        debug_print('view controller: ' + value)
-        return value
+        if self.flush_interval and time.time() - self.last_write >= self.flush_interval:
+            self.write()
+    
+    def restart(self):
+        self.last = None
+        self.last_label = ''
+    
+    def flush(self):
+        if self.dirty:
+            self.write()
+    
+    def close(self):
+        self.flush()
+        if self.renderer:
+            self.renderer.close()
+    
+    def write(self):
+        tmp_filename = self.filename + '.tmp'
+        with stats.timed('write graph'), open(tmp_filename, 'w') as f:
+            self.serialize(f)
+        os.rename(tmp_filename, self.filename)
+        self.last_write = time.time()
+        self.dirty = False
+        if self.renderer:
+            self.renderer.request()
 
-    @property
-    def output(self): 
-        #TODO rewrite this to reduce complexity of node traversal (like https://stackoverflow.com/a/10289740)
+    def spill(self):
+        """
+        Appends the nodes and edges in memory to graph.spill, which serialize
+        copies as is, and starts over with an empty graph (keeping clusters
+        and the last node, as the source of the next edge).
+        """
+        graph = self.graph
+        with stats.timed('spill graph'), open(self.spill_filename, 'a') as f:
+            self.serialize_graph(f, GraphvizOutput.labeler())
+        for cluster, members in enumerate(graph.members):
+            if members:
+                self.tails[cluster] = graph.identifiers[members[-1]]
+        
+        self.graph = GraphvizOutput.Graph()
+        self.graph.keys = graph.keys
+        self.graph.members = [array.array('l') for _ in graph.members]
+        self.last = self.graph.add_node(graph.identifiers[self.last], GraphvizOutput.Graph.spilled)
+        self.spilled = True
+    
+    @staticmethod
+    def labeler():
+        labels = {}
         
-        queue = [self.root]
-        visited = sets.Set()
+        def label(text):
+            if text not in labels:
+                labels[text] = textwrap.fill(text.replace('"', '\\"'))
+            return labels[text]
         
-        nodes_text = ''
-        edges_text = ''
+        return label
+    
+    def serialize(self, f):
+        label = GraphvizOutput.labeler()
         
-        while queue:
-            node = queue.pop(0)
-            visited.add(node)
-            
-            if not self.reentry:
-                nodes_text += str(node)
-                
-            for edge in node.edges:
-                if not edge.dst in visited:
-                    queue.append(edge.dst)
-                    edges_text += str(edge)
+        f.write(textwrap.dedent('''
+            digraph G {
+                rankdir = LR;
+                node [shape=rect, labelloc=b];
+        '''))
+        
+        if self.aggregate:
+            self.serialize_aggregate(f, label)
+            return
+        
+        if self.spilled:
+            with open(self.spill_filename, 'r') as spill:
+                shutil.copyfileobj(spill, f)
+        self.serialize_graph(f, label)
+        
+        f.write('\n}\n')
+    
+    def serialize_graph(self, f, label):
+        graph = self.graph
+        
+        def node_text(node):
+            return '\n\tN%s [image="%s", label="%s"];' % (
+                graph.identifiers[node],
+                graph.images[node],
+                label(graph.labels[node]),
+            )
         
         if self.reentry:
-            subgraph = 0                
-            for key, nodes in self.nodes.iteritems():
-                n = ''.join([str(node) for node in nodes])
-                pairs = list(zip(nodes, nodes[1:]))
-                e = ''.join(['N%s -> N%s [style=invis, constraint=false];\n' % (str(s.state.identifier), str(d.state.identifier)) for s, d in pairs])
-                nodes_text += '''
+            keys = dict((cluster, key) for key, cluster in graph.keys.iteritems())
+            for cluster, members in enumerate(graph.members):
+                if not members:
+                    continue
+                f.write('''
                     subgraph cluster_%i {
+                        key = "%s";
                         style = filled;
                         color = lightgrey;
                         edge [dir=none];
-                        %s
-                        %s
+                        ''' % (cluster, keys[cluster].replace('\\', '\\\\').replace('"', '\\"')))
+                for node in members:
+                    f.write(node_text(node))
+                f.write('\n')
+                chain = [graph.identifiers[node] for node in members]
+                if cluster in self.tails: # reopened after a spill
+                    chain.insert(0, self.tails[cluster])
+                for src, dst in itertools.izip(chain, itertools.islice(chain, 1, None)):
+                    f.write('N%s -> N%s [style=invis, constraint=false];\n' % (src, dst))
+                f.write('''
                     }
-                ''' % (subgraph, n, e)
-                subgraph += 1
+                ''')
+        else:
+            for node in xrange(len(graph)):
+                if graph.clusters[node] != GraphvizOutput.Graph.spilled:
+                    f.write(node_text(node))
         
-        output = textwrap.dedent('''
-            digraph G {
-                rankdir = LR;
-                node [shape=rect, labelloc=b];
-                %s
-                %s
-            }
-        ''') % (nodes_text, edges_text)
+        for src, dst, count in graph.edges():
+            f.write('\n\tN%s -> N%s [label="%s"%s];' % (
+                graph.identifiers[src],
+                graph.identifiers[dst],
+                label(graph.edge_labels.get((src, dst), '')),
+                (', weight=%i' % count) if count > 1 else '',
+            ))
+    
+    def serialize_aggregate(self, f, label):
+        graph = self.graph
+        
+        for node in xrange(len(graph)):
+            f.write('\n\tN%s [image="%s", label="%s\\n(%i)", hits=%i, first="%s", last="%s"];' % (
+                graph.identifiers[node],
+                graph.images[node],
+                label(graph.labels[node]),
+                graph.hits[node],
+                graph.hits[node],
+                graph.identifiers[node],
+                graph.last_identifiers.get(node, graph.identifiers[node]),
+            ))
+        
+        edges = graph.edges()
+        if self.top_edges:
+            edges = sorted(heapq.nlargest(self.top_edges, edges, key=lambda edge: edge[2]))
+        for src, dst, count in edges:
+            first, last = graph.spans[(src, dst)]
+            f.write('\n\tN%s -> N%s [label="%i", weight=%i, penwidth=%.1f, hits=%i, first="%s", last="%s"];' % (
+                graph.identifiers[src],
+                graph.identifiers[dst],
+                count,
+                count,
+                1 + math.log(count, 2),
+                count,
+                first,
+                last,
+            ))
+        
+        f.write('\n}\n')
+
+    @property
+    def output(self): 
+        f = StringIO.StringIO()
+        self.serialize(f)
+        output = f.getvalue()
         debug_print('GraphvizOutput: ' + output)
         return output
 
 
+class HtmlOutput(Output):
+    """
+    Writes a static viewer, index.html, for the session in session.js: one
+    lane per screen, states from top to bottom in the order they were traced,
+    and breakpoints in the lane of the last touched screen. The viewer only
+    renders the states scrolled into view, so screenshots are loaded lazily,
+    and can search states by id, screen, description or breakpoint. It works
+    offline, from the output directory.
+    """
+    
+    version = 1
+    
+    page = textwrap.dedent(r'''
+    <!DOCTYPE html>
+    <html>
+    <head>
+    <meta charset="utf-8">
+    <title>Screengraph</title>
+    <style>
+    body { margin: 0; font: 12px -apple-system, Helvetica, sans-serif; display: flex; flex-direction: column; height: 100vh; }
+    #bar { padding: 6px; border-bottom: 1px solid #ccc; display: flex; align-items: center; }
+    #bar > * { margin-right: 8px; }
+    #search { width: 360px; }
+    #view { flex: 1; overflow: auto; position: relative; }
+    #lanes { position: sticky; top: 0; z-index: 2; height: 24px; background: #f4f4f4; border-bottom: 1px solid #ccc; }
+    .lane { position: absolute; top: 0; height: 24px; line-height: 24px; padding: 0 4px; box-sizing: border-box; overflow: hidden; white-space: nowrap; text-overflow: ellipsis; border-left: 1px solid #ddd; }
+    #content { position: relative; }
+    #edges { position: absolute; pointer-events: none; }
+    .node { position: absolute; box-sizing: border-box; padding: 2px; overflow: hidden; cursor: pointer; background: #fff; border: 1px solid #bbb; border-radius: 3px; }
+    .node img { display: block; max-width: 100%; max-height: 100px; margin: auto; }
+    .node .label { height: 28px; overflow: hidden; font-size: 11px; word-break: break-all; }
+    .node.touch { border-color: #d33; }
+    .node.mark { border-color: #393; }
+    .node.match { outline: 2px solid #fc0; }
+    .node.current { outline: 3px solid #06f; }
+    #details { position: fixed; top: 40px; right: 0; bottom: 0; width: 360px; padding: 8px; overflow: auto; z-index: 3; display: none; background: #fff; border-left: 1px solid #ccc; }
+    #details img { max-width: 100%; }
+    </style>
+    </head>
+    <body>
+    <div id="bar">
+    <input id="search" placeholder="Search: state id, screen, text, b:&lt;breakpoint id&gt; or s:&lt;screen&gt;">
+    <button id="previous">&#9650;</button><button id="next">&#9660;</button>
+    <span id="count"></span>
+    <span id="summary"></span>
+    </div>
+    <div id="view"><div id="lanes"></div><div id="content"><canvas id="edges"></canvas></div></div>
+    <div id="details"></div>
+    <script src="session.js"></script>
+    <script>
+    (function() {
+        // Only the rows in view are rendered, so screenshots load as they scroll into view.
+        var LANE = 180, ROW = 150, MARGIN = 10, HEADER = 25, OVERSCAN = 4;
+        var session = SESSION, nodes = session.nodes; // [id, lane, kind, label, image, breakpoint]
+        var view = document.getElementById('view'), content = document.getElementById('content');
+        var lanes = document.getElementById('lanes'), canvas = document.getElementById('edges');
+        var details = document.getElementById('details'), count = document.getElementById('count');
+        var kinds = {t: 'touch', b: 'breakpoint', m: 'mark'};
+        var rendered = {}, matches = [], matched = {}, current = -1, scheduled = false;
+    
+        content.style.width = lanes.style.width = (session.lanes.length * LANE) + 'px';
+        content.style.height = (nodes.length * ROW + MARGIN) + 'px';
+        session.lanes.forEach(function(key, index) {
+            var lane = document.createElement('div');
+            lane.className = 'lane';
+            lane.style.left = (index * LANE) + 'px';
+            lane.style.width = LANE + 'px';
+            lane.textContent = lane.title = key || '(start)';
+            lanes.appendChild(lane);
+        });
+        document.getElementById('summary').textContent = nodes.length + ' states, ' + session.lanes.length + ' screens';
+    
+        function x(row) { return nodes[row][1] * LANE + MARGIN / 2; }
+        function y(row) { return row * ROW + MARGIN; }
+    
+        function element(row) {
+            var node = nodes[row], e = document.createElement('div');
+            e.className = 'node ' + kinds[node[2]];
+            e.style.left = x(row) + 'px';
+            e.style.top = y(row) + 'px';
+            e.style.width = (LANE - MARGIN) + 'px';
+            e.style.height = (ROW - MARGIN) + 'px';
+            if (node[4]) {
+                var image = document.createElement('img');
+                image.src = node[4];
+                e.appendChild(image);
+            }
+            var label = document.createElement('div');
+            label.className = 'label';
+            label.textContent = node[0] + ' ' + node[3];
+            e.appendChild(label);
+            e.title = node[3];
+            e.onclick = function() { select(row); };
+            return e;
+        }
+    
+        function render() {
+            var top = Math.max(0, view.scrollTop - HEADER), height = view.clientHeight;
+            var first = Math.max(0, Math.floor(top / ROW) - OVERSCAN);
+            var last = Math.min(nodes.length - 1, Math.ceil((top + height) / ROW) + OVERSCAN);
+            for (var row in rendered) {
+                if (row < first || row > last) {
+                    content.removeChild(rendered[row]);
+                    delete rendered[row];
+                }
+            }
+            for (row = first; row <= last; row++) {
+                if (!rendered[row]) {
+                    content.appendChild(rendered[row] = element(row));
+                }
+                rendered[row].classList.toggle('match', !!matched[row]);
+                rendered[row].classList.toggle('current', matches[current] === row);
+            }
+            edges(first, last, top, height);
+        }
+    
+        function edges(first, last, top, height) {
+            canvas.style.left = view.scrollLeft + 'px';
+            canvas.style.top = top + 'px';
+            canvas.width = view.clientWidth;
+            canvas.height = height;
+            var context = canvas.getContext('2d');
+            context.translate(-view.scrollLeft, -top);
+            context.strokeStyle = '#888';
+            context.beginPath();
+            for (var row = Math.max(first, 1); row <= last; row++) {
+                context.moveTo(x(row - 1) + (LANE - MARGIN) / 2, y(row - 1) + ROW - MARGIN);
+                context.lineTo(x(row) + (LANE - MARGIN) / 2, y(row));
+            }
+            context.stroke();
+        }
+    
+        function schedule() {
+            if (!scheduled) {
+                scheduled = true;
+                requestAnimationFrame(function() { scheduled = false; render(); });
+            }
+        }
+    
+        function select(row) {
+            var node = nodes[row];
+            details.innerHTML = '';
+            var close = document.createElement('button');
+            close.textContent = 'Close';
+            close.onclick = function() { details.style.display = 'none'; };
+            details.appendChild(close);
+            [['State', node[0]], ['Kind', kinds[node[2]]], ['Screen', session.lanes[node[1]]], ['Breakpoint', node[5]], ['Description', node[3]]].forEach(function(field) {
+                if (field[1] !== null && field[1] !== undefined) {
+                    var p = document.createElement('p');
+                    p.textContent = field[0] + ': ' + field[1];
+                    details.appendChild(p);
+                }
+            });
+            if (node[4]) {
+                var link = document.createElement('a'), image = document.createElement('img');
+                link.href = image.src = node[4].replace(/^(screenshots\/[0-9a-f]+)\./, '$1.full.');
+                image.onerror = function() { image.onerror = null; link.href = image.src = node[4]; }; // no original kept
+                link.appendChild(image);
+                details.appendChild(link);
+            }
+            details.style.display = 'block';
+            location.hash = node[0];
+        }
+    
+        function search(query) {
+            query = query.trim().toLowerCase();
+            matches = [];
+            matched = {};
+            current = -1;
+            var breakpoint = /^b:(\d+)$/.exec(query), screen = /^s:(.+)$/.exec(query);
+            var screens = session.lanes.map(function(key) { return key.toLowerCase(); });
+            for (var row = 0; query && row < nodes.length; row++) {
+                var node = nodes[row];
+                if (breakpoint ? node[5] === +breakpoint[1] :
+                    screen ? screens[node[1]].indexOf(screen[1]) >= 0 :
+                    node[0].toLowerCase() === query || screens[node[1]].indexOf(query) >= 0 || node[3].toLowerCase().indexOf(query) >= 0) {
+                    matches.push(row);
+                    matched[row] = true;
+                }
+            }
+            count.textContent = query ? matches.length + ' matches' : '';
+            if (matches.length) {
+                go(0);
+            } else {
+                render();
+            }
+        }
+    
+        function go(index) {
+            current = (index + matches.length) % matches.length;
+            var row = matches[current];
+            view.scrollTop = y(row) + HEADER - view.clientHeight / 2;
+            view.scrollLeft = x(row) - view.clientWidth / 2;
+            count.textContent = (current + 1) + ' / ' + matches.length;
+            render();
+        }
+    
+        var input = document.getElementById('search'), timeout = null;
+        input.oninput = function() {
+            clearTimeout(timeout);
+            timeout = setTimeout(function() { search(input.value); }, 150);
+        };
+        input.onkeydown = function(event) {
+            if (event.key === 'Enter' && matches.length) {
+                go(current + (event.shiftKey ? -1 : 1));
+            }
+        };
+        document.getElementById('previous').onclick = function() { if (matches.length) { go(current - 1); } };
+        document.getElementById('next').onclick = function() { if (matches.length) { go(current + 1); } };
+        view.addEventListener('scroll', schedule);
+        window.addEventListener('resize', schedule);
+    
+        if (location.hash) {
+            input.value = decodeURIComponent(location.hash.slice(1));
+            search(input.value);
+        } else {
+            render();
+        }
+    })();
+    </script>
+    </body>
+    </html>
+    ''').lstrip()
+    
+    def __init__(self, directory, runtime=None, flush_interval=0):
+        self.filename = os.path.join(directory, 'session.js')
+        self.runtime = runtime
+        self.flush_interval = flush_interval # seconds, 0 to only write on flush/stop
+        self.keys = [] # lane -> screen key
+        self.lanes = {} # screen key -> lane
+        self.lane = None # of the last touch
+        self.nodes = [] # [identifier, lane, kind, description, image, breakpoint id]
+        self.dirty = False
+        self.last_write = time.time()
+        with open(os.path.join(directory, 'index.html'), 'w') as f:
+            f.write(HtmlOutput.page)
+    
+    def prepare(self, state):
+        if isinstance(state, TouchState) and self.runtime:
+            self.runtime.visible_view_controller(state)
+    
+    def process(self, state):
+        if isinstance(state, TouchState) or self.lane is None:
+            key = (state.key or '') if isinstance(state, TouchState) else ''
+            self.lane = self.lanes.get(key)
+            if self.lane is None:
+                self.lane = self.lanes[key] = len(self.keys)
+                self.keys.append(key)
+        self.nodes.append([
+            state.identifier,
+            self.lane,
+            't' if isinstance(state, TouchState) else 'm' if isinstance(state, MarkState) else 'b',
+            str(state),
+            state.image or '',
+            state.breakpoint_id if isinstance(state, BreakpointState) else None,
+        ])
+        self.dirty = True
+        if self.flush_interval and time.time() - self.last_write >= self.flush_interval:
+            self.write()
+    
+    def restart(self):
+        self.lane = None
+    
+    def flush(self):
+        if self.dirty:
+            self.write()
+    
+    def write(self):
+        tmp_filename = self.filename + '.tmp'
+        with stats.timed('write session'), open(tmp_filename, 'w') as f:
+            f.write('var SESSION = ')
+            json.dump({'version': HtmlOutput.version, 'lanes': self.keys, 'nodes': self.nodes}, f, separators=(',', ':'))
+            f.write(';\n')
+        os.rename(tmp_filename, self.filename)
+        self.last_write = time.time()
+        self.dirty = False
+
+
+class EventLogOutput(Output):
+    """
+    Records states to events.jsonl, one JSON object per line after a
+    versioned header, so graphs can be built later without the debugger:
+    
+        python screengraph.py build ~/screengraph/events.jsonl
+    """
+    
+    version = 1
+    
+    def __init__(self, directory, runtime):
+        self.filename = os.path.join(directory, 'events.jsonl')
+        self.runtime = runtime
+        self.file = open(self.filename, 'w')
+        self.file.write(json.dumps({'format': 'screengraph-events', 'version': EventLogOutput.version}) + '\n')
+    
+    @staticmethod
+    def read(filename):
+        with open(filename, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != 'screengraph-events' or header.get('version') > EventLogOutput.version:
+                raise ValueError('%s is not a screengraph event log this version can read' % filename)
+            for line in f:
+                yield State.from_record(json.loads(line))
+    
+    def prepare(self, state):
+        if isinstance(state, TouchState):
+            self.runtime.visible_view_controller(state)
+        elif state.frame and state.screen is None: # as SQLiteOutput, for sessions built later
+            state.screen = self.runtime.read_visible_key(state.frame.GetThread().GetProcess())
+    
+    def process(self, state):
+        self.file.write(json.dumps(state.record(), separators=(',', ':')) + '\n')
+    
+    def flush(self):
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+
+class SQLiteOutput(Output):
+    """
+    Stores states, screens and screen transitions in session.db, so sessions
+    can be queried, e.g. for the breakpoints hit on a screen:
+    
+        python screengraph.py query --screen MyViewController ~/screengraph/session.db
+    
+    Inserts are committed in batches, in WAL mode.
+    """
+    
+    schema = '''
+        CREATE TABLE states (
+            id TEXT PRIMARY KEY,
+            time REAL,
+            kind TEXT,
+            screen TEXT,
+            key TEXT,
+            breakpoint INTEGER,
+            location INTEGER,
+            pc INTEGER,
+            description TEXT,
+            x REAL,
+            y REAL,
+            image TEXT
+        );
+        CREATE TABLE screens (
+            key TEXT PRIMARY KEY,
+            hits INTEGER,
+            first TEXT,
+            last TEXT,
+            image TEXT
+        );
+        CREATE TABLE transitions (
+            state TEXT,
+            time REAL,
+            source TEXT,
+            destination TEXT
+        );
+        CREATE INDEX states_screen ON states (screen);
+        CREATE INDEX states_breakpoint ON states (breakpoint);
+        CREATE INDEX states_time ON states (time);
+        CREATE INDEX transitions_screens ON transitions (source, destination);
+    '''
+    
+    def __init__(self, directory, runtime=None, batch_size=256, flush_interval=1):
+        self.filename = os.path.join(directory, 'session.db')
+        self.runtime = runtime
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # seconds between commits, 0 to only commit full batches
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False) # created here, used on the writer thread
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SQLiteOutput.schema)
+        self.screen = None # last visible screen
+        self.pending = 0
+        self.last_commit = time.time()
+    
+    def prepare(self, state):
+        if isinstance(state, TouchState):
+            state.screen = self.runtime.visible_view_controller(state)
+        elif self.runtime and state.frame:
+            state.screen = self.runtime.read_visible_key(state.frame.GetThread().GetProcess())
+    
+    def process(self, state):
+        if state.key is None:
+            state.key = str(state)
+        record = state.record()
+        screen = state.screen
+        if screen is None:
+            screen = record.get('key') if record['kind'] == 'touch' else self.screen
+        
+        self.connection.execute(
+            'INSERT INTO states VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                record['id'],
+                record.get('time'),
+                record['kind'],
+                screen,
+                state.key,
+                record.get('breakpoint'),
+                record.get('location'),
+                record.get('pc'),
+                record.get('description', record.get('tag')),
+                record.get('x'),
+                record.get('y'),
+                record.get('image'),
+            ))
+        if screen is not None:
+            self.connection.execute('INSERT OR IGNORE INTO screens VALUES (?, 0, ?, ?, ?)', (screen, record['id'], record['id'], record.get('image')))
+            self.connection.execute('UPDATE screens SET hits = hits + 1, last = ?, image = coalesce(image, ?) WHERE key = ?', (record['id'], record.get('image'), screen))
+            if screen != self.screen:
+                self.connection.execute('INSERT INTO transitions VALUES (?, ?, ?, ?)', (record['id'], record.get('time'), self.screen, screen))
+                self.screen = screen
+        
+        self.pending += 1
+        if self.pending >= self.batch_size or (self.flush_interval and time.time() - self.last_commit >= self.flush_interval):
+            self.flush()
+    
+    def restart(self):
+        self.screen = None
+    
+    def flush(self):
+        with stats.timed('SQLiteOutput.commit'):
+            self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+    
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
 #-- State
 
-class State:
+class State(object):
+    """
+    What was traced at one stop. The frame and location are only set while the
+    process is stopped, for the outputs' prepare step; the dispatcher then
+    detaches them, and outputs only use the recorded fields.
+    """
+    
+    __slots__ = ('identifier', 'frame', 'location', 'key', 'screen', 'time', 'screenshot', 'pixels', 'image')
+    
+    def __init__(self, identifier, frame, location):
+        self.identifier = identifier
+        self.frame = frame
+        self.location = location
+        self.key = None # visible view controller, or breakpoint description, used for clustering
+        self.screen = None # visible view controller, when known
+        self.time = None # when the state was dispatched
+        self.screenshot = None # screenshot status
+        self.pixels = None # raw screenshot, until encoded
+        self.image = None # screenshot file name, relative to the output directory
     
     def __str__(self):
         raise NotImplementedError
-        
-    @property
-    def identifier(self):
-        raise NotImplementedError
-        
-    @property
-    def frame(self):
-        raise NotImplementedError
+    
+    def detach(self):
+        """Drops the frame and location, which are invalid once the process is resumed."""
+        self.frame = None
+        self.location = None
+    
+    def record(self):
+        """Frame-free representation of the state, see EventLogOutput."""
+        record = {'id': self.identifier}
+        if self.time is not None:
+            record['time'] = self.time
+        if self.key is not None:
+            record['key'] = self.key
+        if self.screen is not None:
+            record['screen'] = self.screen
+        if self.image is not None:
+            record['image'] = self.image
+        return record
+    
+    @staticmethod
+    def from_record(record):
+        if record['kind'] == 'touch':
+            state = TouchState(record['id'], record['x'], record['y'], None, None)
+        elif record['kind'] == 'mark':
+            state = MarkState(record['id'], record['tag'])
+        else:
+            state = BreakpointState(record['id'], None, None)
+            state.breakpoint_id = record.get('breakpoint')
+            state.location_id = record.get('location')
+            state.pc = record.get('pc')
+            state.thread_id = record.get('thread')
+            state.description = record.get('description', '')
+        state.key = record.get('key', None if isinstance(state, TouchState) else str(state))
+        state.screen = record.get('screen')
+        state.image = record.get('image')
+        state.time = record.get('time')
+        return state
+
+
+class Symbolicator:
+    """
+    Describes code addresses, e.g. "App`-[ViewController viewDidLoad] + 24 at
+    ViewController.m:20", looking each address up once.
+    """
+    
+    def __init__(self, target):
+        self.target = target
+        self.descriptions = {} # load address -> description
+    
+    def describe(self, pc):
+        description = self.descriptions.get(pc)
+        if description is None:
+            with stats.timed('symbolicate'):
+                description = self.descriptions[pc] = str(self.target.ResolveLoadAddress(pc))
+        return description
 
 
 class BreakpointState(State):
     
-    def __init__(self, identifier, frame, location):
-        self.identifier = identifier
-        self.frame = frame
-        self.location = location
+    __slots__ = ('symbolicator', 'breakpoint_id', 'location_id', 'pc', 'thread_id', 'description')
+    
+    def __init__(self, identifier, frame, location, symbolicator=None):
+        State.__init__(self, identifier, frame, location)
+        self.symbolicator = symbolicator
+        self.breakpoint_id = self.location_id = self.pc = self.thread_id = None
+        self.description = None # resolved from pc on first use, unless rebuilt from an event log
+        if frame: # not when rebuilt from an event log
+            self.breakpoint_id = location.GetBreakpoint().id
+            self.location_id = location.GetID()
+            self.pc = frame.GetPC()
+            self.thread_id = frame.GetThread().GetThreadID()
+            if symbolicator is None:
+                self.description = str(frame) # the frame is no longer valid once the process is resumed
         
     def __repr__(self):
-        return '<State (%s): breakpoint %s, function %s>' % (
+        return '<State (%s): breakpoint %s, pc 0x%x>' % (
             self.identifier,
-            self.location.GetBreakpoint().id,
-            self.frame.name,
+            self.breakpoint_id,
+            self.pc,
         )
     
     def __str__(self):
-        return str(self.frame)
+        if self.description is None:
+            self.description = self.symbolicator.describe(self.pc)
+        return self.description
+    
+    def record(self):
+        record = State.record(self)
+        record.update({
+            'kind': 'breakpoint',
+            'breakpoint': self.breakpoint_id,
+            'location': self.location_id,
+            'pc': self.pc,
+            'thread': self.thread_id,
+            'description': str(self),
+        })
+        if record.get('key') == self.description:
+            del record['key'] # the default key
+        return record
 
 
 class TouchState(State):
     
+    __slots__ = ('x', 'y')
+    
     def __init__(self, identifier, x, y, frame, location):
-        self.identifier = identifier
+        State.__init__(self, identifier, frame, location)
         self.x = x
         self.y = y
-        self.frame = frame
-        self.location = location
         
     def __repr__(self):
         return '<State (%s): touch (%i, %i)>' % (
@@ -386,11 +2074,193 @@ class TouchState(State):
             self.x,
             self.y,
         )
+    
+    def record(self):
+        record = State.record(self)
+        record.update({
+            'kind': 'touch',
+            'x': self.x,
+            'y': self.y,
+        })
+        return record
+
+
+class MarkState(State):
+    """A call site tagged by the app, see Recorder."""
+    
+    __slots__ = ('tag',)
+    
+    def __init__(self, identifier, tag):
+        State.__init__(self, identifier, None, None)
+        self.tag = tag
+    
+    def __repr__(self):
+        return '<State (%s): mark %s>' % (
+            self.identifier,
+            self.tag,
+        )
+    
+    def __str__(self):
+        return self.tag
+    
+    def record(self):
+        record = State.record(self)
+        record.update({
+            'kind': 'mark',
+            'tag': self.tag,
+        })
+        if record.get('key') == self.tag:
+            del record['key'] # the default key
+        return record
+
+
+#-- Dispatch
+
+class Dispatcher:
+    """
+    Runs the outputs' prepare step on the stopped process, and queues their
+    process step (formatting, disk I/O) for a writer thread, so the process
+    can be resumed right away.
+    """
+    
+    def __init__(self, outputs, maxsize=1024):
+        self.outputs = outputs
+        self.queue = Queue.Queue(maxsize) # bounded: tracers block when the writer falls behind
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='screengraph writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                task()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+    
+    def dispatch(self, *states):
+        """Dispatches the states of one stop; outputs prepare them in order, and can share work between them."""
+        now = time.time()
+        for state in states:
+            if state.time is None:
+                state.time = now
+        for output in self.outputs:
+            with stats.timed(output.__class__.__name__ + '.prepare'):
+                for state in states:
+                    output.prepare(state)
+        for state in states:
+            state.detach()
+        with stats.timed('queue'):
+            self.queue.put(lambda: self.process(*states))
+    
+    def process(self, *states):
+        """Processes states on the writer thread; an output failing does not keep the others from their data."""
+        for state in states:
+            for output in self.outputs:
+                try:
+                    with stats.timed(output.__class__.__name__ + '.process'):
+                        output.process(state)
+                except Exception:
+                    traceback.print_exc()
+    
+    def each(self, method):
+        for output in self.outputs:
+            try:
+                getattr(output, method)()
+            except Exception:
+                traceback.print_exc()
+    
+    def flush(self):
+        """Waits for pending states to be processed, then flushes the outputs."""
+        if not self.closed:
+            self.queue.put(lambda: self.each('flush'))
+            self.queue.join()
+    
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(lambda: self.each('close'))
+            self.queue.put(None)
+            self.thread.join()
 
 
 #-- Tracing
 
 class Tracer:
+    """
+    Traces one target. Breakpoint callbacks are looked up by name, so tracers
+    started on a target register in their class's instances, by process, and
+    the callbacks dispatch to the tracers of the process that stopped.
+    
+    When several threads stop at traced locations at once, LLDB calls the
+    callbacks once per thread; the first call of a stop traces all of them,
+    see on_stop, and the others return.
+    """
+    
+    handled = {} # process key -> id of the last stop traced
+    
+    @staticmethod
+    def process_key(process):
+        return process.GetUniqueID()
+    
+    @staticmethod
+    def on_stop(frame, location):
+        """
+        Traces every thread stopped at a traced location, in thread order so
+        identifiers are deterministic, dispatches their states together (see
+        Dispatcher.dispatch), and resumes the process once.
+        """
+        process = frame.GetThread().GetProcess()
+        key = Tracer.process_key(process)
+        stop = process.GetStopID()
+        if Tracer.handled.get(key) == stop:
+            return # another thread of a stop already traced
+        Tracer.handled[key] = stop
+        tracers = [tracer for tracer in (TouchTracer.instances.get(key), BreakpointTracer.instances.get(key)) if tracer]
+        if not tracers:
+            return
+        
+        start = timer()
+        try:
+            target = process.GetTarget()
+            threads = {} # thread index id -> (frame, locations)
+            for index in xrange(process.GetNumThreads()):
+                thread = process.GetThreadAtIndex(index)
+                if thread.GetStopReason() == lldb.eStopReasonBreakpoint:
+                    data = [thread.GetStopReasonDataAtIndex(i) for i in xrange(thread.GetStopReasonDataCount())]
+                    threads[thread.GetIndexID()] = (thread.GetFrameAtIndex(0), [
+                        target.FindBreakpointByID(data[i]).FindLocationByID(data[i + 1]) for i in xrange(0, len(data) - 1, 2)
+                    ])
+            threads.setdefault(frame.GetThread().GetIndexID(), (frame, [location])) # in case its stop reason was not reported
+
+            states = []
+            for index in sorted(threads):
+                thread_frame, locations = threads[index]
+                debug_print('frame: ' + str(thread_frame))
+                state = None
+                for thread_location in locations:
+                    for tracer in tracers:
+                        state = state or tracer.trace(thread_frame, thread_location)
+                if state:
+                    debug_print('state: ' + repr(state))
+                    states.append(state)
+            if states:
+                tracers[0].dispatcher.dispatch(*states)
+            stats.record('stop', timer() - start)
+            if len(states) > 1:
+                stats.count('states in shared stops', len(states))
+        finally: # the other callbacks of this stop return, so this one resumes the process even if tracing failed
+            process.Continue()
+    
+    def trace(self, frame, location):
+        """Returns the state for a thread stopped at location, None if not traced by this tracer."""
+        return None
     
     def start(self):
         raise NotImplementedError
@@ -399,13 +2269,18 @@ class Tracer:
         raise NotImplementedError
 
 
-@singleton
 class BreakpointTracer(Tracer):
-
-    def __init__(self, debugger, outputs):
+    
+    instances = {} # process key -> started tracer
+    
+    def __init__(self, debugger, dispatcher, target=None):
         self.debugger = debugger
-        self.outputs = outputs
+        self.target = target or debugger.GetSelectedTarget()
+        self.dispatcher = dispatcher
         self._current_idx = 0
+        self.breakpoints = []
+        self.ids = set() # of the traced breakpoints
+        self.symbolicator = None
     
     def __del__(self):
         self.stop()
@@ -413,12 +2288,14 @@ class BreakpointTracer(Tracer):
     def start(self):
         debug_print('starting breakpoint tracer')
         self.breakpoints = []
-        target = self.debugger.GetSelectedTarget()
-        for breakpoint in target.breakpoint_iter():
+        self.symbolicator = Symbolicator(self.target)
+        BreakpointTracer.instances[Tracer.process_key(self.target.GetProcess())] = self
+        for breakpoint in self.target.breakpoint_iter():
             if breakpoint.IsValid() and breakpoint.IsEnabled():
                 debug_print('breakpoint: ' + str(breakpoint))
-                breakpoint.SetScriptCallbackFunction('screengraph.BreakpointTracer.instance.on_breakpoint_hit')
+                breakpoint.SetScriptCallbackFunction('screengraph.BreakpointTracer.on_hit')
                 self.breakpoints.append(breakpoint)
+                self.ids.add(breakpoint.GetID())
     
     def stop(self):
         debug_print('stopping breakpoint tracer')
@@ -427,15 +2304,22 @@ class BreakpointTracer(Tracer):
                 dir(breakpoint)
                 breakpoint.SetScriptCallbackFunction("")
         self.breakpoints = []
+        self.ids = set()
+        key = Tracer.process_key(self.target.GetProcess())
+        if BreakpointTracer.instances.get(key) is self:
+            del BreakpointTracer.instances[key]
+    
+    @staticmethod
+    def on_hit(frame, location, internal_dict):
+        if frame.IsValid():
+            Tracer.on_stop(frame, location)
         
     def on_breakpoint_hit(self, frame, location, internal_dict):
-        if frame.IsValid():
-            debug_print('frame: ' + str(frame))
-            state = BreakpointState(self.current_identifier, frame, location)
-            debug_print('state: ' + repr(state))
-            for output in self.outputs:
-                output.process(state)
-            frame.GetThread().GetProcess().Continue()
+        BreakpointTracer.on_hit(frame, location, internal_dict)
+    
+    def trace(self, frame, location):
+        if location.GetBreakpoint().GetID() in self.ids:
+            return BreakpointState(self.current_identifier, frame, location, self.symbolicator)
     
     @property
     def current_identifier(self):
@@ -444,20 +2328,35 @@ class BreakpointTracer(Tracer):
         return 'b' + str(ret)
 
 
-@singleton
 class TouchTracer(Tracer):
     
-    def __init__(self, debugger, outputs):
+    modes = ('hook', 'condition')
+    instances = {} # process key -> started tracer
+    
+    def __init__(self, debugger, dispatcher, runtime, mode='hook', target=None):
         self.debugger = debugger
-        self.outputs = outputs
+        self.target = target or debugger.GetSelectedTarget()
+        self.dispatcher = dispatcher
+        self.runtime = runtime
+        self.mode = mode
         self._current_idx = 0
         self.hitTest = None
     
     def start(self):
         debug_print('starting touch tracer')
-        target = self.debugger.GetSelectedTarget()
+        target = self.target
+        TouchTracer.instances[Tracer.process_key(target.GetProcess())] = self
+        
+        if self.mode == 'hook':
+            address = self.runtime.install_touch_hook()
+            if address:
+                self.hitTest = target.BreakpointCreateByAddress(address)
+                self.hitTest.SetScriptCallbackFunction('screengraph.TouchTracer.on_hit')
+                return
+            print('Screengraph could not install touch hook, falling back to conditional breakpoint')
+            self.mode = 'condition'
 
-        first_arg = first_argument()
+        first_arg = first_argument(target)
         condition = '(int)[%s type] == 0 && (int)[[[%s allTouches] anyObject] phase] == 0' % (
             first_arg,
             first_arg
@@ -465,18 +2364,36 @@ class TouchTracer(Tracer):
 
         self.hitTest = target.BreakpointCreateByName('-[UIApplication sendEvent:]')
         self.hitTest.SetCondition(condition) 
-        self.hitTest.SetScriptCallbackFunction('screengraph.TouchTracer.instance.on_touch')
+        self.hitTest.SetScriptCallbackFunction('screengraph.TouchTracer.on_hit')
         
     def stop(self):
         debug_print('stopping touch tracer')
-        #TODO implement TouchTracer stop
-        raise NotImplementedError 
+        if self.hitTest and self.hitTest.IsValid():
+            self.target.BreakpointDelete(self.hitTest.GetID())
+        self.hitTest = None
+        if self.mode == 'hook':
+            self.runtime.remove_touch_hook()
+        key = Tracer.process_key(self.target.GetProcess())
+        if TouchTracer.instances.get(key) is self:
+            del TouchTracer.instances[key]
     
-    def on_touch(self, frame, location, internal_dict):
+    @staticmethod
+    def on_hit(frame, location, internal_dict):
         if frame.IsValid():
-            debug_print('touch: ' + str(frame))
-            
-            first_arg = first_argument()
+            Tracer.on_stop(frame, location)
+    
+    def on_touch(self, frame, location, internal_dict):
+        TouchTracer.on_hit(frame, location, internal_dict)
+    
+    def trace(self, frame, location):
+        if not self.hitTest or location.GetBreakpoint().GetID() != self.hitTest.GetID():
+            return None
+        debug_print('touch: ' + str(frame))
+        
+        if self.mode == 'hook':
+            x, y = self.runtime.read_touch_location(frame.GetThread().GetProcess())
+        else:
+            first_arg = first_argument(self.target)
             value = frame.EvaluateExpression('''
                 @import CoreGraphics; 
                 UIEvent *event = %s; 
@@ -486,13 +2403,8 @@ class TouchTracer(Tracer):
             ''' % first_arg) 
             x = float(value.GetChildMemberWithName('x').GetValue())
             y = float(value.GetChildMemberWithName('y').GetValue())
-            
-            state = TouchState(self.current_identifier, x, y, frame, location)
-            debug_print('state: ' + repr(state))
-            
-            for output in self.outputs:
-                output.process(state)
-            frame.GetThread().GetProcess().Continue()
+        
+        return TouchState(self.current_identifier, x, y, frame, location)
     
     @property
     def current_identifier(self):
@@ -501,10 +2413,170 @@ class TouchTracer(Tracer):
         return 't' + str(ret)
         
 
+class Recorder(Tracer):
+    """
+    Non-stop tracing: the app appends touches (with the visible view
+    controller key, and a screenshot it saved itself) and marks to a ring
+    buffer in recorder.ring, which it maps into memory; a host thread tails
+    the file and dispatches the records as states, so the process never
+    stops for them. Needs the app and the host to share the file system,
+    i.e. the simulator.
+    
+    recorder.ring is a header, then capacity bytes of records written
+    around the ring:
+    
+        magic 'SGRB', version, capacity (3 x uint32), reserved (uint32)
+        position (uint64): bytes written since start, records before it are complete
+        ... padding to offset 64
+    
+    Each record is Recorder.record (size, kind, flags, sequence, time, x, y,
+    key length, text length), then the key and text, in UTF-8. When the host
+    falls behind by more than the capacity, records are lost and counted as
+    'recorder overrun'. See benchmark/stubs/recorder.py for a writer.
+    """
+    
+    magic = 'SGRB'
+    version = 1
+    header = struct.Struct('<4sIII')
+    position = struct.Struct('<Q')
+    record = struct.Struct('<HBBIdffHH')
+    offset = 64 # of the records
+    max_record = record.size + 2 * Runtime.key_size
+    touch, mark = 1, 2 # kinds
+    saved = 1 # flag, the app saved a screenshot
+    interval = 0.05 # seconds between reads
+    
+    def __init__(self, debugger, dispatcher, runtime, directory, capacity=1 << 20, screenshots=None):
+        self.debugger = debugger
+        self.dispatcher = dispatcher
+        self.runtime = runtime
+        self.filename = os.path.join(directory, 'recorder.ring')
+        self.capacity = max(capacity, 4 * Recorder.max_record) # reads within max_record of an overrun are dropped
+        self.screenshots = screenshots # ScreenshotOutput, or None for no screenshots
+        self.map = None
+        self.read_position = 0
+        self.stopped = threading.Event()
+        self.thread = None
+    
+    @staticmethod
+    def create(filename, capacity):
+        """Creates an empty ring buffer file and returns it mapped into memory."""
+        with open(filename, 'w+b') as f:
+            f.write(Recorder.header.pack(Recorder.magic, Recorder.version, capacity, 0))
+            f.write(Recorder.position.pack(0))
+            f.truncate(Recorder.offset + capacity)
+            f.flush()
+            return mmap.mmap(f.fileno(), Recorder.offset + capacity)
+    
+    def start(self):
+        debug_print('starting recorder')
+        self.map = Recorder.create(self.filename, self.capacity)
+        self.read_position = 0
+        prefix, extension = None, 'png'
+        if self.screenshots:
+            prefix, extension = os.path.join(self.screenshots.directory, 'screenshot_r'), self.screenshots.store.extension
+        if not self.runtime.start_recorder(self.filename, self.capacity, prefix, extension):
+            print('Screengraph could not start the recorder in the app')
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='screengraph recorder')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        debug_print('stopping recorder')
+        if self.thread:
+            self.runtime.stop_recorder()
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        if self.map:
+            self.map.close()
+            self.map = None
+    
+    def run(self):
+        while True:
+            stopped = self.stopped.wait(Recorder.interval)
+            try:
+                self.poll()
+            except Exception:
+                traceback.print_exc()
+            if stopped:
+                return
+    
+    def poll(self):
+        for kind, flags, sequence, timestamp, x, y, key, text in self.read():
+            identifier = 'r%i' % sequence
+            if kind == Recorder.touch:
+                state = TouchState(identifier, x, y, None, None)
+                state.key = key
+                if flags & Recorder.saved:
+                    state.screenshot = 'saved'
+            else:
+                state = MarkState(identifier, text)
+                state.screen = key
+            state.time = timestamp
+            self.dispatcher.dispatch(state)
+            stats.count('recorded')
+    
+    def read(self):
+        """Returns the records written since the last read."""
+        end, = Recorder.position.unpack_from(self.map, Recorder.header.size)
+        start = self.read_position
+        if end - start > self.capacity:
+            return self.overrun(end)
+        data = self.slice(start, end)
+        # the writer may have wrapped around onto what was just copied
+        written, = Recorder.position.unpack_from(self.map, Recorder.header.size)
+        if written + Recorder.max_record - start > self.capacity:
+            return self.overrun(written)
+        self.read_position = end
+        
+        records = []
+        offset = 0
+        while offset < len(data):
+            size, kind, flags, sequence, timestamp, x, y, key_length, text_length = Recorder.record.unpack_from(data, offset)
+            key_offset = offset + Recorder.record.size
+            text_offset = key_offset + key_length
+            records.append((kind, flags, sequence, timestamp, x, y, data[key_offset:text_offset], data[text_offset:text_offset + text_length]))
+            offset += size
+        return records
+    
+    def slice(self, start, end):
+        first, length = Recorder.offset + start % self.capacity, end - start
+        wrapped = first + length - (Recorder.offset + self.capacity)
+        if wrapped > 0:
+            return self.map[first:Recorder.offset + self.capacity] + self.map[Recorder.offset:Recorder.offset + wrapped]
+        return self.map[first:first + length]
+    
+    def overrun(self, position):
+        stats.count('recorder overrun')
+        self.read_position = position
+        return []
+
+
 #-- Command
 
 class ScreenGraphCommand:
     program = 'screengraph'
+    
+    class Session:
+        """The runtime, outputs and tracers of one target, writing to their own directory."""
+        
+        def __init__(self, target, directory, runtime, dispatcher, tracers):
+            self.target = target
+            self.directory = directory
+            self.runtime = runtime
+            self.dispatcher = dispatcher
+            self.tracers = tracers
+        
+        def start(self):
+            [tracer.start() for tracer in self.tracers]
+        
+        def stop(self):
+            [tracer.stop() for tracer in self.tracers]
+            self.runtime.remove_visible_key_tracking()
+            self.dispatcher.close()
 
     @classmethod
     def register_lldb_command(cls, debugger, module_name):
@@ -519,7 +2591,7 @@ class ScreenGraphCommand:
 
     @classmethod
     def create_options(cls):
-        usage = "usage: %prog start|stop"
+        usage = "usage: %prog start|stop|flush|stats"
         description = ('Creates a graph of screens.')
         
         parser = optparse.OptionParser(
@@ -532,7 +2604,37 @@ class ScreenGraphCommand:
             "-t", "--type",
             metavar='type',
             default='graph',
-            help='Output type: linear or graph (default=graph)',
+            help='Output type: linear, graph, or aggregate (one node per screen, one edge per transition) (default=graph)',
+        )
+        
+        parser.add_option(
+            "--sqlite",
+            action='store_true',
+            default=False,
+            help='Also store states, screens and transitions in session.db, see "screengraph.py query"',
+        )
+        
+        parser.add_option(
+            "--max-nodes",
+            metavar='count',
+            type='int',
+            default=0,
+            help='Keep at most this many graph nodes in memory, spilling older ones to graph.spill, 0 for no limit (default=0)',
+        )
+        
+        parser.add_option(
+            "--html",
+            action='store_true',
+            default=False,
+            help='Also write a viewer for large sessions, index.html, which works offline',
+        )
+        
+        parser.add_option(
+            "--top-edges",
+            metavar='count',
+            type='int',
+            default=0,
+            help='With --type aggregate, only keep the most frequent transitions, 0 for all (default=0)',
         )
         
         parser.add_option(
@@ -542,6 +2644,181 @@ class ScreenGraphCommand:
             help='Output directory (default=~/screengraph)',
         )
         
+        parser.add_option(
+            "-T", "--targets",
+            metavar='targets',
+            default='selected',
+            help='Targets to trace: selected, all, or comma-separated indexes as listed by "target list"; '
+                 'other than selected, each target writes to its own shard directory, <directory>/<app>-<pid>, '
+                 'see "screengraph.py merge" (default=selected)',
+        )
+        
+        parser.add_option(
+            "-r", "--record",
+            action='store_true',
+            default=False,
+            help='Only record events (and screenshots) to events.jsonl; build the graph later with "python screengraph.py build"',
+        )
+        
+        parser.add_option(
+            "-i", "--flush-interval",
+            metavar='seconds',
+            type='float',
+            default=10,
+            help='Rewrite graph.dot at most every so many seconds, 0 to only write on flush or stop (default=10)',
+        )
+        
+        parser.add_option(
+            "-g", "--render",
+            metavar='formats',
+            default='png',
+            help='Comma-separated Graphviz output formats to render graph.dot to, in the background, e.g. png,svg; empty for none (default=png)',
+        )
+        
+        parser.add_option(
+            "-q", "--queue-size",
+            metavar='states',
+            type='int',
+            default=1024,
+            help='Number of states waiting to be written before tracing blocks (default=1024)',
+        )
+        
+        parser.add_option(
+            "--timings",
+            metavar='file',
+            help='With start, also write every raw timing to this file',
+        )
+        
+        parser.add_option(
+            "-x", "--expression-timeout",
+            metavar='seconds',
+            type='float',
+            default=2.0,
+            help='Timeout for expressions evaluated in the app on each event (default=2)',
+        )
+        
+        parser.add_option(
+            "-s", "--screenshot-mode",
+            metavar='mode',
+            type='choice',
+            choices=ScreenshotOutput.modes,
+            default='raw',
+            help='Screenshots: raw (render in the app, encode on the host after resuming) or app (encode and write in the app) (default=raw)',
+        )
+        
+        parser.add_option(
+            "--screenshot-scale",
+            metavar='scale',
+            type='float',
+            default=1.0,
+            help='Screenshot pixels per point (default=1)',
+        )
+        
+        parser.add_option(
+            "--screenshot-max-size",
+            metavar='pixels',
+            type='int',
+            default=0,
+            help='Maximum screenshot width or height, 0 for no limit (default=0)',
+        )
+        
+        parser.add_option(
+            "--screenshot-format",
+            metavar='format',
+            type='choice',
+            choices=ScreenshotOutput.formats,
+            default='png',
+            help='Screenshot format: png, jpeg (needs PIL in raw mode) or heic (app mode only) (default=png)',
+        )
+        
+        parser.add_option(
+            "--screenshot-quality",
+            metavar='quality',
+            type='float',
+            default=0.8,
+            help='JPEG/HEIC quality, between 0 and 1 (default=0.8)',
+        )
+        
+        parser.add_option(
+            "--screenshot-rate",
+            metavar='per-second',
+            type='float',
+            default=0,
+            help='Take at most this many screenshots per second, preferring screen transitions; others reuse the last screenshot, 0 for no limit; needs --vc-tracking push (default=0)',
+        )
+        
+        parser.add_option(
+            "--screenshot-burst",
+            metavar='count',
+            type='int',
+            default=5,
+            help='With --screenshot-rate, screenshots that can be taken in a row (default=5)',
+        )
+        
+        parser.add_option(
+            "--screenshot-interval",
+            metavar='seconds',
+            type='float',
+            default=0,
+            help='Take at most one screenshot per screen every so many seconds, 0 for no limit; needs --vc-tracking push (default=0)',
+        )
+        
+        parser.add_option(
+            "--screen-identity",
+            metavar='bits',
+            type='int',
+            default=-1,
+            help='Cluster screens by screenshot instead of view controller: screenshots whose perceptual hashes differ by at most so many bits (out of 64) are the same screen, -1 to use view controllers (default=-1)',
+        )
+        
+        parser.add_option(
+            "--thumbnail-size",
+            metavar='pixels',
+            type='int',
+            default=0,
+            help='Have the graph reference thumbnails of at most this width or height, 0 for full screenshots (default=0)',
+        )
+        
+        parser.add_option(
+            "--keep-originals",
+            action='store_true',
+            default=False,
+            help='With --thumbnail-size, also keep full-resolution screenshots',
+        )
+        
+        parser.add_option(
+            "--vc-tracking",
+            metavar='mode',
+            type='choice',
+            choices=('push', 'poll'),
+            default='push',
+            help='Visible view controller: push (tracked by the app on viewDidAppear, read from memory) or poll (looked up on each touch) (default=push)',
+        )
+        
+        parser.add_option(
+            "--non-stop",
+            action='store_true',
+            default=False,
+            help='Have the app record touches (and screenshots) to recorder.ring instead of stopping at them, simulator only',
+        )
+        
+        parser.add_option(
+            "--recorder-size",
+            metavar='bytes',
+            type='int',
+            default=1 << 20,
+            help='With --non-stop, size of the ring buffer the app records to (default=1048576)',
+        )
+        
+        parser.add_option(
+            "-m", "--touch-mode",
+            metavar='mode',
+            type='choice',
+            choices=TouchTracer.modes,
+            default='hook',
+            help='Touch capture: hook (filter touches in the app, only stop on touch began) or condition (conditional breakpoint on -[UIApplication sendEvent:]) (default=hook)',
+        )
+        
         #TODO add command option for graph orientation
         #TODO add command option to disable continuing after hitting a breakpoint
         #TODO add command option to select outputs
@@ -556,8 +2833,7 @@ class ScreenGraphCommand:
 
     def __init__(self, debugger, unused):
         self.parser = self.create_options()
-        self.tracers = []
-        self.tracing = False
+        self.sessions = collections.OrderedDict() # process key -> Session
         
     def __call__(self, debugger, command, exe_ctx, result):
         command_args = shlex.split(command)
@@ -572,48 +2848,499 @@ class ScreenGraphCommand:
         else:
             subcommand = args[0]
         
-        if subcommand == 'start' and not self.tracing:
+        if subcommand == 'start':
+            targets = [target for target in self.targets(debugger, options.targets)
+                       if Tracer.process_key(target.GetProcess()) not in self.sessions]
+            if not targets:
+                return
             print('starting screengraph')
-            outputs = self.make_outputs(
-                debugger, 
-                options.directory,
-                reentry = (options.type == 'graph')
-            )
-
-            self.tracers = self.make_tracers(debugger, outputs)
-            self.tracing = True
-            [tracer.start() for tracer in self.tracers]
+            if not self.sessions:
+                stats.reset(options.timings)
+            for target in targets:
+                directory = options.directory
+                if options.targets != 'selected':
+                    directory = os.path.join(directory, ScreenGraphCommand.shard(target))
+                try:
+                    session = self.make_session(debugger, target, directory, options)
+                except ValueError, e:
+                    print('Screengraph could not start: ' + str(e))
+                    return
+                self.sessions[Tracer.process_key(target.GetProcess())] = session
+                session.start()
             
             #TODO investigate why resuming debugger after starting screengraph does not work
             #debugger.GetSelectedTarget().GetProcess().Continue()
             
-        elif subcommand == 'stop' and self.tracing:
+        elif subcommand == 'stop' and self.sessions:
             print('stopping screengraph')
-            [tracer.stop() for tracer in self.tracers]
-            self.tracing = False
+            for session in self.sessions.values():
+                session.stop()
+            self.sessions.clear()
+            stats.close()
+            
+        elif subcommand == 'flush' and self.sessions:
+            for session in self.sessions.values():
+                session.dispatcher.flush()
             
-    def make_tracers(self, debugger, outputs, breakpoint=True, touch=True):
+        elif subcommand == 'stats':
+            for session in self.sessions.values():
+                session.dispatcher.flush()
+            print(stats.report())
+    
+    def targets(self, debugger, targets):
+        """The targets selected by --targets, that have a process to trace."""
+        if targets == 'selected':
+            selected = [debugger.GetSelectedTarget()]
+        elif targets == 'all':
+            selected = [debugger.GetTargetAtIndex(index) for index in xrange(debugger.GetNumTargets())]
+        else:
+            try:
+                selected = [debugger.GetTargetAtIndex(int(index)) for index in targets.split(',')]
+            except ValueError:
+                print('Screengraph could not start: expected selected, all or target indexes, got ' + targets)
+                return []
+        ret = []
+        for target in selected:
+            if target.IsValid() and target.GetProcess().IsValid():
+                ret.append(target)
+            else:
+                print('Screengraph could not start on %s: no process' % (target.GetExecutable().GetFilename() if target.IsValid() else 'target'))
+        return ret
+    
+    @staticmethod
+    def shard(target):
+        """Directory name for a target's outputs, unique among the processes being debugged."""
+        return '%s-%i' % (target.GetExecutable().GetFilename() or 'target', target.GetProcess().GetProcessID())
+    
+    def make_session(self, debugger, target, directory, options):
+        if options.non_stop and options.screen_identity >= 0 and not Image:
+            # recorded touches are always saved by the app, whatever the screenshot mode
+            raise ValueError('identifying screens of touches recorded with --non-stop requires PIL, their screenshots are saved by the app')
+        runtime = Runtime(debugger, timeout=options.expression_timeout, target=target)
+        runtime.install()
+        if options.vc_tracking == 'push' or options.non_stop: # recorded touches need the key tracked by the app
+            runtime.install_visible_key_tracking()
+        outputs = self.make_outputs(
+            runtime,
+            directory,
+            reentry = (options.type == 'graph'),
+            aggregate = (options.type == 'aggregate'),
+            top_edges = options.top_edges,
+            max_nodes = options.max_nodes,
+            flush_interval = options.flush_interval,
+            render = [format for format in options.render.split(',') if format],
+            record = options.record,
+            events = (options.targets != 'selected'), # for merging shards
+            sqlite = options.sqlite,
+            html = options.html,
+            screenshot_options = {
+                'mode': options.screenshot_mode,
+                'scale': options.screenshot_scale,
+                'max_size': options.screenshot_max_size,
+                'format': options.screenshot_format,
+                'quality': options.screenshot_quality,
+                'thumbnail_size': options.thumbnail_size,
+                'keep_originals': options.keep_originals,
+                'rate': options.screenshot_rate,
+                'burst': options.screenshot_burst,
+                'min_interval': options.screenshot_interval,
+                'identity_threshold': options.screen_identity,
+            },
+        )
+        dispatcher = Dispatcher(outputs, maxsize=options.queue_size)
+        tracers = self.make_tracers(
+            debugger,
+            dispatcher,
+            runtime,
+            touch_mode=options.touch_mode,
+            recorder=({'directory': directory, 'capacity': options.recorder_size} if options.non_stop else None),
+            target=target,
+        )
+        return ScreenGraphCommand.Session(target, directory, runtime, dispatcher, tracers)
+            
+    def make_tracers(self, debugger, dispatcher, runtime, breakpoint=True, touch=True, touch_mode='hook', recorder=None, target=None):
         tracers = []
         if breakpoint:
-            tracers.append(BreakpointTracer(debugger, outputs))
-        if touch:
-            tracers.append(TouchTracer(debugger, outputs))
+            tracers.append(BreakpointTracer(debugger, dispatcher, target=target))
+        if touch and recorder:
+            screenshots = [output for output in dispatcher.outputs if isinstance(output, ScreenshotOutput) and output.on_touch]
+            tracers.append(Recorder(debugger, dispatcher, runtime, screenshots=(screenshots[0] if screenshots else None), **recorder))
+        elif touch:
+            tracers.append(TouchTracer(debugger, dispatcher, runtime, mode=touch_mode, target=target))
         return tracers
     
-    def make_outputs(self, debugger, directory, text=debug(), screenshot=True, graphviz=True, reentry=True):
+    def make_outputs(self, runtime, directory, text=debug(), screenshot=True, graphviz=True, reentry=True, flush_interval=0, screenshot_options=None, record=False, render=None, aggregate=False, top_edges=0, sqlite=False, max_nodes=0, html=False, events=False):
         make_directory_if_not_exist(directory)
+        if record:
+            text = graphviz = False
         outputs = []
         if text:
             outputs.append(TextOutput(directory))
         if screenshot:
-            outputs.append(ScreenshotOutput(directory, debugger, on_touch=True, on_breakpoint=False))
+            outputs.append(ScreenshotOutput(directory, runtime, on_touch=True, on_breakpoint=False, **(screenshot_options or {})))
         if graphviz:
-            outputs.append(GraphvizOutput(directory, reentry=reentry))
+            outputs.append(GraphvizOutput(
+                directory,
+                reentry=reentry,
+                flush_interval=flush_interval,
+                runtime=runtime,
+                render=render,
+                aggregate=aggregate,
+                top_edges=top_edges,
+                max_nodes=max_nodes,
+            ))
+        if html:
+            outputs.append(HtmlOutput(directory, runtime, flush_interval=flush_interval))
+        if sqlite:
+            outputs.append(SQLiteOutput(directory, runtime))
+        if record or events:
+            outputs.append(EventLogOutput(directory, runtime))
         return outputs
 
+
+#-- Offline tools
+
+def build_parser(description, usage):
+    """Options shared by the tools building outputs from event logs, build and merge."""
+    parser = optparse.OptionParser(description=description, usage=usage)
+    parser.add_option('-t', '--type', metavar='type', default='graph', help='Output type: linear, graph or aggregate (default=graph)')
+    parser.add_option('--top-edges', metavar='count', type='int', default=0,
+                      help='With --type aggregate, only keep the most frequent transitions, 0 for all (default=0)')
+    parser.add_option('--max-nodes', metavar='count', type='int', default=0,
+                      help='Keep at most this many graph nodes in memory, spilling older ones to graph.spill, 0 for no limit (default=0)')
+    parser.add_option('-l', '--labelpos', metavar='position', type='choice', choices=('node', 'edge', 'none'), default='node',
+                      help='Put labels on nodes, edges or none (default=node)')
+    parser.add_option('-g', '--render', metavar='formats', default='', help='Comma-separated Graphviz output formats to render graph.dot to, e.g. png,svg')
+    parser.add_option('--sqlite', action='store_true', default=False, help='Also build session.db, see "screengraph.py query"')
+    parser.add_option('--html', action='store_true', default=False, help='Also build the viewer, index.html')
+    return parser
+
+def build_outputs(options, directory):
+    make_directory_if_not_exist(directory)
+    outputs = [
+        TextOutput(directory, append=False),
+        GraphvizOutput(
+            directory,
+            reentry=(options.type == 'graph'),
+            aggregate=(options.type == 'aggregate'),
+            top_edges=options.top_edges,
+            max_nodes=options.max_nodes,
+            labelpos=(None if options.labelpos == 'none' else options.labelpos),
+            render=[format for format in options.render.split(',') if format],
+        ),
+    ]
+    if options.html:
+        outputs.append(HtmlOutput(directory))
+    if options.sqlite:
+        outputs.append(SQLiteOutput(directory, flush_interval=0))
+    return outputs
+
+def build(argv):
+    parser = build_parser(
+        description='Builds trace.txt and graph.dot from an event log recorded with "screengraph start --record".',
+        usage='usage: %prog build [options] events.jsonl',
+    )
+    parser.add_option('-d', '--directory', metavar='directory', help='Output directory (default=the event log\'s directory)')
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected one event log')
+    
+    outputs = build_outputs(options, options.directory or os.path.dirname(os.path.abspath(args[0])))
+    for state in EventLogOutput.read(args[0]):
+        for output in outputs:
+            output.process(state)
+    for output in outputs:
+        output.close()
+
+def merge(argv):
+    parser = build_parser(
+        description='Merges the shards of a multi-target session ("screengraph start --targets all"), or any event logs, '
+                    'into a single trace.txt and graph.dot. Screens with the same key share a cluster, and identical '
+                    'screenshots are stored once. States are renamed <shard>_<id>, shards numbered in the order given.',
+        usage='usage: %prog merge [options] shard|events.jsonl ...',
+    )
+    parser.add_option('-d', '--directory', metavar='directory', help='Output directory (default=the first shard\'s parent directory)')
+    parser.add_option('--screen-identity', metavar='bits', type='int', default=-1,
+                      help='Identify screens again from their screenshots, across shards, as with "screengraph start --screen-identity" '
+                           '(needs PIL), -1 to keep the shards\' keys (default=-1)')
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error('expected shard directories or event logs')
+    if options.screen_identity >= 0 and not Image:
+        parser.error('--screen-identity requires PIL')
+    logs = [os.path.join(arg, 'events.jsonl') if os.path.isdir(arg) else arg for arg in args]
+    for log in logs:
+        if not os.path.exists(log):
+            parser.error('%s does not exist' % log)
+    
+    directory = options.directory or os.path.dirname(os.path.dirname(os.path.abspath(logs[0])))
+    outputs = build_outputs(options, directory)
+    identity = ScreenIdentity(options.screen_identity) if options.screen_identity >= 0 else None
+    copied = set() # screenshot objects already in the merged directory
+    for shard, log in enumerate(logs):
+        source = os.path.dirname(os.path.abspath(log))
+        for output in outputs:
+            output.restart()
+        for state in EventLogOutput.read(log):
+            state.identifier = '%i_%s' % (shard, state.identifier)
+            if state.image:
+                if state.image not in copied:
+                    copied.add(state.image)
+                    for name in (state.image, state.image.replace('.', '.full.', 1)):
+                        filename = os.path.join(directory, name)
+                        if os.path.exists(os.path.join(source, name)) and not os.path.exists(filename):
+                            make_directory_if_not_exist(os.path.dirname(filename))
+                            shutil.copyfile(os.path.join(source, name), filename)
+                if identity and isinstance(state, TouchState):
+                    filename = os.path.join(directory, state.image)
+                    state.key = identity.identify(os.path.basename(state.image).split('.')[0], lambda: dhash_file(filename))
+            for output in outputs:
+                output.process(state)
+    for output in outputs:
+        output.close()
+
+def query(argv):
+    parser = optparse.OptionParser(
+        description='Queries a session database recorded with "screengraph start --sqlite" or "screengraph.py build --sqlite". '
+                    'Without options or SQL, lists screens by number of hits.',
+        usage='usage: %prog query [options] session.db [sql]',
+    )
+    parser.add_option('-s', '--screen', metavar='key', help='List the breakpoints hit on a screen')
+    parser.add_option('-b', '--breakpoint', metavar='id', type='int', help='List the screens a breakpoint is hit on')
+    parser.add_option('-t', '--transitions', action='store_true', default=False, help='List transitions between screens by number of hits')
+    (options, args) = parser.parse_args(argv)
+    if len(args) not in (1, 2):
+        parser.error('expected a session database and an optional SQL statement')
+    if not os.path.exists(args[0]):
+        parser.error('%s does not exist' % args[0])
+    
+    if len(args) == 2:
+        sql, parameters = args[1], ()
+    elif options.screen is not None:
+        # ids are compared as text ('b10' < 'b9'), the first hit is the first row
+        sql = '''SELECT hits.breakpoint, hits.description, hits.hits, states.id AS first FROM
+                     (SELECT breakpoint, description, COUNT(*) AS hits, MIN(rowid) AS row FROM states
+                      WHERE kind = 'breakpoint' AND screen = ? GROUP BY breakpoint, description) AS hits
+                 JOIN states ON states.rowid = hits.row ORDER BY hits.hits DESC'''
+        parameters = (options.screen,)
+    elif options.breakpoint is not None:
+        sql = '''SELECT screen, COUNT(*) AS hits, MIN(time) AS first, MAX(time) AS last FROM states
+                 WHERE breakpoint = ? GROUP BY screen ORDER BY hits DESC'''
+        parameters = (options.breakpoint,)
+    elif options.transitions:
+        sql = '''SELECT source, destination, COUNT(*) AS hits FROM transitions
+                 GROUP BY source, destination ORDER BY hits DESC'''
+        parameters = ()
+    else:
+        sql, parameters = 'SELECT key, hits, first, last, image FROM screens ORDER BY hits DESC', ()
+    
+    connection = sqlite3.connect(args[0])
+    try:
+        cursor = connection.execute(sql, parameters)
+    except sqlite3.Error, e:
+        print('Screengraph could not query %s: %s' % (args[0], e))
+        return 1
+    if cursor.description:
+        print('\t'.join(column[0] for column in cursor.description))
+    for row in cursor:
+        print('\t'.join('' if value is None else unicode(value).encode('utf-8') for value in row))
+    connection.close()
+
+class Summary:
+    """
+    What a session covers, for comparing sessions: screens, transitions
+    between screens, and which breakpoints (or marks) were hit on which
+    screens, with counts. Breakpoints are identified by their symbol and
+    file, see canonical, as ids, addresses and lines change between builds.
+    """
+    
+    def __init__(self, lines=False):
+        self.lines = lines # keep line numbers in breakpoint locations
+        self.screens = collections.Counter()
+        self.transitions = collections.Counter() # (screen, screen)
+        self.mappings = collections.Counter() # (breakpoint location, screen)
+        self.screen = None
+        self.locations = {} # description -> location
+    
+    def canonical(self, description):
+        location = self.locations.get(description)
+        if location is None:
+            location = ' '.join(description.split())
+            location = re.sub(r'^frame #\d+: 0x[0-9a-fA-F]+ ', '', location) # SBFrame descriptions
+            location = re.sub(r'\([^()]*=[^()]*\)', '', location) # argument values
+            location = re.sub(r' \+ \d+', '', location) # offsets
+            if not self.lines:
+                location = re.sub(r'(\S):\d+(:\d+)?$', r'\1', location)
+            self.locations[description] = location
+        return location
+    
+    def add(self, touch, key):
+        """Adds a touch on the screen key, or a breakpoint hit or mark described by key."""
+        if touch:
+            if self.screen is not None and key != self.screen:
+                self.transitions[(self.screen, key)] += 1
+            self.screen = key
+            self.screens[key] += 1
+        else:
+            self.mappings[(self.canonical(key), self.screen)] += 1
+    
+    @staticmethod
+    def read(filename, lines=False):
+        summary = Summary(lines)
+        with open(filename, 'r') as f:
+            start = f.read(1)
+        if start == '{':
+            summary.read_events(filename)
+        else:
+            summary.read_graph(filename)
+        return summary
+    
+    def read_events(self, filename):
+        for state in EventLogOutput.read(filename):
+            if isinstance(state, TouchState):
+                self.add(True, state.key or '')
+            else:
+                self.add(False, str(state))
+    
+    graph_tokens = re.compile(r'''
+        ^[\ \t]*(?:
+            (?P<cluster>subgraph\ cluster_\d+\ \{)
+            | key\ =\ "(?P<key>(?:[^"\\]|\\.)*)";
+            | N(?P<node>\w+)\ \[image="[^"]*",\ label="(?P<label>(?:[^"\\]|\\.)*)"(?P<hits>,\ hits=)?
+            | N(?P<src>\w+)\ ->\ N(?P<dst>\w+)\ \[(?P<attributes>(?:[^"\]]|"(?:[^"\\]|\\.)*")*)\]
+            | (?P<end>\})
+        )
+    ''', re.M | re.X) # statements start lines, multi-line labels are consumed with their node
+    
+    def read_graph(self, filename):
+        """Reads a graph.dot written with --type graph; touches get the key of their cluster."""
+        with open(filename, 'r') as f:
+            dot = f.read()
+        
+        def unescape(text):
+            return ' '.join(text.split()).replace('\\"', '"').replace('\\\\', '\\')
+        
+        order = [] # nodes, in declaration order
+        labels = {}
+        clusters = {} # node -> cluster key
+        edges = {} # src -> (dst, label)
+        targets = set()
+        key = None
+        for token in Summary.graph_tokens.finditer(dot):
+            if token.group('cluster'):
+                key = None
+            elif token.group('key') is not None:
+                key = unescape(token.group('key'))
+            elif token.group('end'):
+                key = None
+            elif token.group('node'):
+                if token.group('hits'):
+                    raise ValueError('%s is an aggregate graph, which does not keep the order of states' % filename)
+                node = token.group('node')
+                order.append(node)
+                labels[node] = unescape(token.group('label'))
+                if key is not None:
+                    clusters[node] = key
+            elif 'invis' not in token.group('attributes'):
+                label = re.search(r'label="((?:[^"\\]|\\.)*)"', token.group('attributes'))
+                edges[token.group('src')] = (token.group('dst'), unescape(label.group(1)) if label else '')
+                targets.add(token.group('dst'))
+        
+        for start in order:
+            if start in targets:
+                continue
+            self.screen = None # each chain is a trace, e.g. one of the shards of a merged session
+            node = start
+            while node is not None:
+                next, edge_label = edges.get(node, (None, ''))
+                label = labels.get(node) or edge_label # with --labelpos edge, states label their outgoing edge
+                identifier = node.split('_')[-1] # without the shard of merged sessions
+                if identifier.startswith('t') or (identifier.startswith('r') and label.startswith('Touch (')):
+                    if node not in clusters:
+                        raise ValueError('%s has no screen keys, it was not written with --type graph' % filename)
+                    self.add(True, clusters[node])
+                elif label: # unknown for the last state with --labelpos edge
+                    self.add(False, label)
+                node = next
+    
+    def diff(self, other):
+        """Returns what other adds to and removes from this summary."""
+        result = collections.OrderedDict()
+        for name in ('screens', 'transitions', 'mappings'):
+            old, new = getattr(self, name), getattr(other, name)
+            result[name] = collections.OrderedDict([
+                ('added', sorted(item for item in new if item not in old)),
+                ('removed', sorted(item for item in old if item not in new)),
+            ])
+        return result
+
+
+def diff(argv):
+    parser = optparse.OptionParser(
+        description='Compares the screens, screen transitions and breakpoints hit on each screen of two sessions, '
+                    'each an event log (events.jsonl) or a graph (graph.dot, written with --type graph). '
+                    'Exits with 1 when there are differences, see --fail-on.',
+        usage='usage: %prog diff [options] old new',
+    )
+    parser.add_option('--json', action='store_true', default=False, help='Print the differences as JSON')
+    parser.add_option('--lines', action='store_true', default=False, help='Tell breakpoints apart by line number too')
+    parser.add_option('--fail-on', metavar='changes', type='choice', choices=('any', 'removed', 'none'), default='any',
+                      help='Exit with 1 on any difference, only on removed screens, transitions or breakpoints, or never (default=any)')
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('expected two sessions')
+    
+    try:
+        old, new = [Summary.read(filename, options.lines) for filename in args]
+    except (IOError, ValueError), e:
+        print('Screengraph could not compare sessions: ' + str(e))
+        return 2
+    result = old.diff(new)
+    
+    if options.json:
+        print(json.dumps(collections.OrderedDict([
+            ('old', args[0]),
+            ('new', args[1]),
+            ('screens', result['screens']),
+            ('transitions', collections.OrderedDict(
+                (change, [collections.OrderedDict([('from', a), ('to', b)]) for a, b in items])
+                for change, items in result['transitions'].items()
+            )),
+            ('mappings', collections.OrderedDict(
+                (change, [collections.OrderedDict([('breakpoint', a), ('screen', b)]) for a, b in items])
+                for change, items in result['mappings'].items()
+            )),
+        ]), indent=2))
+    else:
+        for name, format in (('screens', '%s'), ('transitions', '%s -> %s'), ('mappings', '%s on %s')):
+            for change, sign in (('removed', '-'), ('added', '+')):
+                for item in result[name][change]:
+                    print('%s %s %s' % (sign, name[:-1], format % item))
+    
+    if options.fail_on == 'any':
+        return int(any(changes for name in result for changes in result[name].values()))
+    if options.fail_on == 'removed':
+        return int(any(result[name]['removed'] for name in result))
+    return 0
+
+def main(argv):
+    tools = {
+        'build': build,
+        'diff': diff,
+        'merge': merge,
+        'query': query,
+    }
+    if len(argv) < 2 or argv[1] not in tools:
+        print('usage: %s %s [options] ...' % (os.path.basename(argv[0]), '|'.join(sorted(tools))))
+        return 1
+    return tools[argv[1]](argv[2:])
+
 def __lldb_init_module(debugger, dict):   
     for _name, cls in inspect.getmembers(sys.modules[__name__]):
         if inspect.isclass(cls) and callable(getattr(cls,
                                                      "register_lldb_command",
                                                      None)):
-            cls.register_lldb_command(debugger, __name__)
\ No newline at end of file
+            cls.register_lldb_command(debugger, __name__)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
\ No newline at end of file